@@ -0,0 +1,721 @@
+"""local stand-ins for the appliance APIs used by the check-plugins.
+
+Every appliance generates a synthetic inventory of 'scale' objects once
+and serves it from a threaded HTTP(S) server on 127.0.0.1. Each request is
+delayed by 'latency' seconds, and requests and bytes moved are counted.
+The answers carry only the fields the plugins read. Paging follows each
+API's own scheme:
+
+	ontap		/api/storage/volumes, disks, luns, aggregates, shelves,
+				/api/cluster/chassis, nodes (max_records, _links.next)
+	fortigate	/api/v2/monitor/... (system, license, vpn, wifi, switch)
+	veeam		:9419/api/v1 (oauth2 token, backups, jobs, sessions with
+				skip/limit, repository states)
+	hpe			/api/v1/credentials, system, volumes, disks (WSAPI)
+	powervault	/api/login, /api/show/*
+	sophos		id and api host in one server: oauth2 token, whoami,
+				partner tenants (page), endpoints (pageFromKey), alerts
+	meraki		/api/v1 organization devices, statuses, uplinks, switch ports
+				(perPage, Link rel=next), network health alerts, the per
+				serial endpoints of the old shell checks; 10 requests per
+				second (429 with Retry-After)
+	icinga		:5665/v1/actions/process-check-result (passive results are
+				kept in 'results')
+	telegram	bot API sendMessage with the per chat rate limit (429 with
+				retry_after), messages are kept in 'messages'
+
+serve_smtp() starts a minimal SMTP server counting connections and mails.
+"""
+
+import os
+import ssl
+import gzip
+import json
+import time
+import bisect
+import random
+import socketserver
+import threading
+import subprocess
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# answers larger than this are gzipped if the client accepts it
+GZIP_MIN = 1024
+
+def make_cert( directory ):
+	"""self-signed certificate for 127.0.0.1; returns (certfile, keyfile)"""
+	cert = os.path.join( directory, 'cert.pem' )
+	key  = os.path.join( directory, 'key.pem' )
+	if not os.path.exists( cert ):
+		subprocess.run( [ 'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+			'-keyout', key, '-out', cert, '-days', '2', '-subj', '/CN=127.0.0.1' ],
+			check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+	return cert, key
+
+def _iso( ts ):
+	return datetime.fromtimestamp( ts, timezone.utc ).strftime( '%Y-%m-%dT%H:%M:%SZ' )
+
+class Stats:
+	"""request and byte counters of one appliance"""
+	def __init__( self ):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset( self ):
+		with self.lock:
+			self.requests  = 0
+			self.bytes_in  = 0
+			self.bytes_out = 0
+
+	def count( self, bytes_in, bytes_out ):
+		with self.lock:
+			self.requests  += 1
+			self.bytes_in  += bytes_in
+			self.bytes_out += bytes_out
+
+	def snapshot( self ):
+		with self.lock:
+			return { 'requests': self.requests, 'bytes_in': self.bytes_in,
+				'bytes_out': self.bytes_out }
+
+class Appliance:
+	"""base class: 'route' maps (method, path, query, body) to (status, answer)"""
+	tls  = True
+	port = 0
+
+	def __init__( self, scale, seed=1 ):
+		self.scale = scale
+		self.random = random.Random( seed )
+		self.build()
+
+	def build( self ):
+		pass
+
+	def route( self, method, path, query, body, headers ):
+		return 404, { 'error': 'not found' }
+
+#-----------------------------------------------------------------------
+# NetApp ONTAP
+#-----------------------------------------------------------------------
+class Ontap( Appliance ):
+	def build( self ):
+		n = self.scale
+		self.started = time.time()
+		self.volumes = [ {
+			'name': 'vol{:05d}'.format(i),
+			'svm': { 'name': 'svm{}'.format( i % 8 ) },
+			'state': 'online' if i % 997 else 'offline',
+			'space': { 'available_percent': self.random.randint( 1, 90 ),
+				'full_threshold_percent': 98, 'nearly_full_threshold_percent': 95 },
+			'rate': self.random.randint( 10, 2000 ),
+			} for i in range(n) ]
+		self.disks = [ { 'name': '1.{}.{}'.format( i // 24, i % 24 ), 'pool': 'pool0',
+			'container_type': 'aggregate' if i % 500 else 'spare', 'bay': i % 24 }
+			for i in range(n) ]
+		self.luns = [ { 'name': '/vol/vol{:05d}/lun0'.format(i), 'status': { 'state': 'online' },
+			'space': { 'used': self.random.randint( 1, 99 ), 'size': 100 } } for i in range(n) ]
+		self.aggregates = [ { 'name': 'aggr{}'.format(i), 'state': 'online',
+			'space': { 'block_storage': { 'used': 40 + i % 50, 'size': 100,
+				'full_threshold_percent': 98 } } } for i in range( max( 2, n // 100 ) ) ]
+		self.shelves = [ { 'uid': 's{}'.format(i), 'name': '1.{}'.format(i), 'model': 'DS224C',
+			'module_type': 'iom12', 'serial_number': 'SHX{:06d}'.format(i), 'disk_count': 24,
+			'state': 'ok', 'frus': [ { 'type': 'module', 'id': m, 'state': 'ok' } for m in 'AB' ],
+			'fans': [ { 'id': f, 'rpm': 3000, 'location': 'rear', 'state': 'ok' } for f in range(4) ],
+			'bays': [ { 'id': b, 'type': 'single_disk', 'state': 'ok', 'has_disk': True }
+				for b in range(24) ] } for i in range( max( 1, n // 24 ) ) ]
+		self.chassis = [ { 'id': 'chassis1', 'state': 'ok',
+			'frus': [ { 'type': 'psu', 'id': str(p), 'state': 'ok' } for p in range(2) ],
+			'shelves': [ { 'uid': s['uid'] } for s in self.shelves ] } ]
+		self.nodes = [ { 'uuid': 'n{}'.format(i), 'name': 'node{}'.format(i), 'state': 'up',
+			'nvram': { 'battery_state': 'battery_ok' },
+			'controller': { 'failed_fan': { 'count': 0, 'message': { 'message': 'ok' } },
+				'failed_power_supply': { 'count': 0, 'message': { 'message': 'ok' } } } }
+			for i in range(2) ]
+
+	def volume_records( self, volumes ):
+		# raw counters grow with the time since start, latency in usec per op
+		now = time.time()
+		t = now - self.started + 3600
+		ts = _iso( now )
+		for vol in volumes:
+			r = vol['rate']
+			iops = { 'read': int( r * t ), 'write': int( r * t / 2 ) }
+			iops['total'] = iops['read'] + iops['write']
+			record = dict( vol )
+			del record['rate']
+			record['statistics'] = { 'status': 'ok', 'timestamp': ts,
+				'iops_raw': iops,
+				'throughput_raw': { op: v * 8192 for op, v in iops.items() },
+				'latency_raw': { op: v * 400 for op, v in iops.items() } }
+			yield record
+
+	def route( self, method, path, query, body, headers ):
+		if path == '/api/cluster':
+			return 200, { 'name': 'bench', 'location': 'lab',
+				'version': { 'generation': 9, 'major': 14, 'minor': 1, 'full': 'NetApp Release 9.14.1' } }
+
+		collections = {
+			'/api/storage/disks':      self.disks,
+			'/api/storage/luns':       self.luns,
+			'/api/storage/aggregates': self.aggregates,
+			'/api/storage/shelves':    self.shelves,
+			'/api/cluster/chassis':    self.chassis,
+			'/api/cluster/nodes':      self.nodes,
+			}
+		if path == '/api/storage/volumes':
+			records = self.volumes
+		elif path in collections:
+			records = collections[path]
+		else:
+			return 404, { 'error': { 'message': 'not found' } }
+
+		if query.get( 'return_records' ) == 'false':
+			return 200, { 'num_records': len( records ) }
+		max_records = int( query.get( 'max_records', 10000 ) )
+		start = int( query.get( 'start', 0 ) )
+		page = records[ start:start + max_records ]
+		if records is self.volumes:
+			page = list( self.volume_records( page ) )
+		answer = { 'records': page, 'num_records': len(page) }
+		if start + max_records < len( records ):
+			query = dict( query, start=start + max_records )
+			answer['_links'] = { 'next': { 'href': path + '?' + urlencode( query, safe=',' ) } }
+		return 200, answer
+
+#-----------------------------------------------------------------------
+# FortiOS
+#-----------------------------------------------------------------------
+class Fortigate( Appliance ):
+	def build( self ):
+		n = self.scale
+		now = int( time.time() )
+		self.license = { name: { 'status': 'licensed', 'expires': now + days * 86400 }
+			for name, days in [ ( 'forticare', 400 ), ( 'antivirus', 200 ), ( 'ips', 200 ),
+				( 'web_filtering', 90 ), ( 'appctrl', 20 ) ] }
+		self.license['vdom'] = { 'status': 'licensed' }
+		connections = max( 1, n // 4 )
+		self.ipsec = [ { 'name': 'vpn{:05d}'.format(c), 'username': 'peer{}'.format(c),
+			'proxyid': [ { 'p2name': 'p2-{}'.format(t), 'p2serial': t,
+				'status': 'up' if ( c * 4 + t ) % 211 else 'down' }
+				for t in range( min( 4, n - c * 4 ) ) ] } for c in range( connections ) ]
+		self.aps = [ { 'name': 'ap{:05d}'.format(i), 'serial': 'FP{:08d}'.format(i),
+			'os_version': 'FP231F-v7.2', 'status': 'connected',
+			'connection_state': 'Connected' if i % 301 else 'Disconnected' } for i in range(n) ]
+		self.switches = [ { 'name': 'sw{:05d}'.format(i), 'serial': 'S1{:08d}'.format(i),
+			'os_version': 'S124F-v7.2', 'status': 'Connected' if i % 401 else 'Down' }
+			for i in range( max( 1, n // 10 ) ) ]
+		self.cpus = [ { 'historical': { '10-min': { 'average': self.random.randint( 1, 60 ) } } }
+			for i in range(8) ]
+
+	def route( self, method, path, query, body, headers ):
+		if path == '/api/v2/monitor/system/status':
+			return 200, { 'results': { 'hostname': 'bench-fw', 'model': 'FGT600F' },
+				'version': 'v7.2.8', 'serial': 'FG6H0F0000000001' }
+		if path == '/api/v2/monitor/system/resource/usage':
+			res = query.get( 'resource', 'cpu' )
+			return 200, { 'results': { res: self.cpus } }
+		answers = {
+			'/api/v2/monitor/license/status': self.license,
+			'/api/v2/monitor/vpn/ipsec': self.ipsec,
+			'/api/v2/monitor/wifi/managed_ap': self.aps,
+			'/api/v2/monitor/switch-controller/managed-switch/status': self.switches,
+			}
+		if path in answers:
+			return 200, { 'results': answers[path] }
+		return 404, { 'error': -3 }
+
+#-----------------------------------------------------------------------
+# Veeam Backup & Replication REST API
+#-----------------------------------------------------------------------
+class Veeam( Appliance ):
+	port = 9419
+
+	def build( self ):
+		n = self.scale
+		now = datetime.now( timezone.utc )
+		self.jobs = [ { 'name': 'Job {:05d}'.format(j), 'jobId': 'job-{:05d}'.format(j),
+			'platformName': 'VMware' } for j in range(n) ]
+		# five daily sessions per job, sorted by creation time
+		self.sessions = []
+		for day in range( 5, 0, -1 ):
+			for j in range(n):
+				result = 'Failed' if ( j % 97 == 0 and day == 1 ) else 'Success'
+				self.sessions.append( { 'id': 's-{}-{}'.format( j, day ), 'jobId': 'job-{:05d}'.format(j),
+					'creationTime': ( now - timedelta( days=day, seconds=j ) ).isoformat(),
+					'state': 'Stopped', 'result': { 'result': result } } )
+		self.sessions.sort( key=lambda s: s['creationTime'] )
+		self.created = [ datetime.fromisoformat( s['creationTime'] ) for s in self.sessions ]
+		self.by_id = { s['id']: s for s in self.sessions }
+		self.repositories = [ { 'name': 'repo{}'.format(r), 'type': 'WinLocal',
+			'capacityGB': 10000.0, 'usedSpaceGB': 1000.0 + r * 37 % 8000 }
+			for r in range( max( 1, n // 50 ) ) ]
+
+	def route( self, method, path, query, body, headers ):
+		if path == '/api/oauth2/token':
+			return 200, { 'access_token': 'bench-token', 'expires_in': 900 }
+		if headers.get( 'Authorization' ) != 'Bearer bench-token':
+			return 401, { 'message': 'unauthorized' }
+		if path == '/api/v1/serverInfo':
+			return 200, { 'buildVersion': '12.2.0.334' }
+		if path == '/api/v1/backups':
+			return 200, { 'data': self.jobs }
+		if path == '/api/v1/jobs':
+			return 200, { 'data': [ { 'name': j['name'], 'id': j['jobId'] } for j in self.jobs ] }
+		if path == '/api/v1/backupInfrastructure/repositories/states':
+			return 200, { 'data': self.repositories }
+		if path == '/api/v1/sessions':
+			since = query.get( 'createdAfterFilter', '1970-01-01T00:00:00Z' ).replace( 'Z', '+00:00' )
+			since = datetime.fromisoformat( since )
+			skip  = int( query.get( 'skip', 0 ) )
+			limit = int( query.get( 'limit', 200 ) )
+			first = bisect.bisect_right( self.created, since )
+			if query.get( 'orderAsc' ) == 'false':
+				last = len( self.sessions ) - skip
+				return 200, { 'data': self.sessions[ max( first, last - limit ):last ][::-1] }
+			return 200, { 'data': self.sessions[ first + skip:first + skip + limit ] }
+		if path.startswith( '/api/v1/sessions/' ):
+			session = self.by_id.get( path.rsplit( '/', 1 )[1] )
+			return ( 200, session ) if session else ( 404, { 'message': 'not found' } )
+		return 404, { 'message': 'not found' }
+
+#-----------------------------------------------------------------------
+# HPE WSAPI (3PAR, Primera, Alletra)
+#-----------------------------------------------------------------------
+class Hpe( Appliance ):
+	def build( self ):
+		n = self.scale
+		self.volumes = [ { 'name': 'vv{:05d}'.format(i), 'state': 1 if i % 499 else 2,
+			'sizeMiB': 1048576, 'totalUsedMiB': self.random.randint( 1000, 1000000 ),
+			'usrSpcAllocWarningPct': 80 } for i in range(n) ]
+		self.disks = [ { 'id': i, 'name': 'disk{}'.format(i), 'position': { 'cage': i // 24, 'slot': i % 24 },
+			'state': 1 if i % 601 else 4, 'totalSizeMiB': 3662848,
+			'freeSizeMiB': self.random.randint( 0, 3662848 ) } for i in range(n) ]
+
+	def route( self, method, path, query, body, headers ):
+		if path == '/api/v1/credentials' and method == 'POST':
+			return 201, { 'key': 'bench-session-key' }
+		if path.startswith( '/api/v1/credentials/' ) and method == 'DELETE':
+			return 200, {}
+		if headers.get( 'X-HP3PAR-WSAPI-SessionKey' ) != 'bench-session-key':
+			return 403, { 'code': 6, 'desc': 'invalid session key' }
+		if path == '/api/v1/system':
+			return 200, { 'id': 1, 'name': 'bench', 'model': 'HPE Alletra 9060',
+				'systemVersion': '9.5.3', 'serialNumber': 'CZ0000000', 'totalNodes': 2 }
+		if path == '/api/v1/volumes':
+			return 200, { 'total': len( self.volumes ), 'members': self.volumes }
+		if path == '/api/v1/disks':
+			return 200, { 'total': len( self.disks ), 'members': self.disks }
+		return 404, { 'code': 23, 'desc': 'not found' }
+
+#-----------------------------------------------------------------------
+# Dell PowerVault ME
+#-----------------------------------------------------------------------
+class Powervault( Appliance ):
+	def build( self ):
+		n = self.scale
+		self.pools = [ { 'name': 'P{}'.format(i), 'health': 'OK', 'health-numeric': 0 if i % 7 else 1,
+			'total-size-numeric': 10**10, 'total-avail-numeric': self.random.randint( 10**8, 10**10 ),
+			'blocksize': 512, 'middle-threshold': '85.00 %', 'high-threshold': '95.00 %' }
+			for i in range( max( 1, n // 100 ) ) ]
+		self.sensors = [ { 'container': 'controllers', 'status': 'OK', 'status-numeric': 1,
+			'sensor-type': 'Temperature', 'value': '{} C'.format( 20 + i % 30 ),
+			'sensor-name': 'Sensor {}'.format(i) } for i in range(n) ]
+		self.psus = [ { 'name': 'PSU {}'.format(i), 'health': 'OK', 'health-numeric': 0,
+			'location': 'Enclosure {} - Left'.format( i // 2 ) } for i in range( max( 2, n // 12 ) ) ]
+
+	def status( self, code=0, response='Command completed successfully.' ):
+		return [ { 'response-type': 'Success', 'return-code': code, 'response': response } ]
+
+	def route( self, method, path, query, body, headers ):
+		if path == '/api/login':
+			return 200, { 'status': self.status( 1, 'bench-session' ) }
+		if headers.get( 'sessionKey' ) != 'bench-session':
+			return 200, { 'status': self.status( -10027, 'Invalid session key' ) }
+
+		answers = {
+			'/api/show/system': ( 'system', [ { 'vendor-name': 'DELL EMC', 'system-information': 'ME5024',
+				'system-name': 'bench', 'midplane-serial-number': '00C0FF000000',
+				'current-node-wwn': '208000c0ff000000', 'system-location': 'lab',
+				'system-contact': 'ops' } ] ),
+			'/api/show/pools': ( 'pools', self.pools ),
+			'/api/show/sensor-status': ( 'sensors', self.sensors ),
+			'/api/show/power-supplies': ( 'power-supplies', self.psus ),
+			'/api/show/controller-statistics': ( 'controller-statistics', [
+				{ 'durable-id': 'controller_a', 'power-on-time': 8640000, 'total-power-on-hours': '24000.5' },
+				{ 'durable-id': 'controller_b', 'power-on-time': 8640000, 'total-power-on-hours': '24000.5' } ] ),
+			'/api/show/versions/detail': ( 'versions', [ { 'object-name': 'controller-{}-versions'.format(c),
+				'bundle-base-version': 'ME5.1.2.0.1', 'bundle-version': 'ME5.1.2.0.1', 'hw-rev': '1.0',
+				'mc-fw': 'E3.1.2', 'sc-fw': 'E3.1.2' } for c in 'ab' ] ),
+			'/api/show/disk-groups': ( 'disk-groups', [] ),
+			'/api/show/volumes': ( 'volumes', [] ),
+			}
+		if path in answers:
+			key, items = answers[path]
+			return 200, { key: items, 'status': self.status() }
+		return 200, { 'status': self.status( -1, 'Unrecognized command' ) }
+
+#-----------------------------------------------------------------------
+# Sophos Central (partner account)
+#-----------------------------------------------------------------------
+class Sophos( Appliance ):
+	tls = False
+	health = [ 'good', 'good', 'good', 'good', 'suspicious', 'bad', 'unknown' ]
+
+	def build( self ):
+		n = self.scale
+		self.base = None        # set by serve()
+		self.tenants = [ { 'id': 'tenant-{:05d}'.format(t), 'name': 'Customer {:05d}'.format(t) }
+			for t in range( max( 1, n // 100 ) ) ]
+		self.endpoints = [ { 'id': 'ep-{}'.format(i), 'hostname': 'pc{:05d}'.format(i),
+			'health': { 'overall': self.health[ i % len( self.health ) ] } } for i in range(n) ]
+		self.alerts = [ { 'severity': ( 'high', 'medium', 'low' )[ i % 3 ],
+			'managedAgent': { 'name': 'pc{:05d}'.format(i) }, 'description': 'alert {}'.format(i) }
+			for i in range( max( 1, n // 20 ) ) ]
+
+	def route( self, method, path, query, body, headers ):
+		if path == '/api/v2/oauth2/token':
+			return 200, { 'access_token': 'bench-token', 'expires_in': 3600, 'token_type': 'bearer' }
+		if headers.get( 'Authorization' ) != 'Bearer bench-token':
+			return 401, { 'error': 'unauthorized' }
+		if path == '/whoami/v1':
+			return 200, { 'id': 'partner-1', 'idType': 'partner',
+				'apiHosts': { 'global': self.base } }
+		if path == '/partner/v1/tenants':
+			size = int( query.get( 'pageSize', 100 ) )
+			page = int( query.get( 'page', 1 ) )
+			items = [ dict( t, apiHost=self.base ) for t in self.tenants[ ( page - 1 ) * size:page * size ] ]
+			return 200, { 'items': items, 'pages': { 'current': page,
+				'total': max( 1, -( -len( self.tenants ) // size ) ) } }
+		if path == '/endpoint/v1/endpoints':
+			endpoints = self.endpoints
+			if query.get( 'healthStatus' ):
+				endpoints = [ e for e in endpoints if e['health']['overall'] == query['healthStatus'] ]
+			size = int( query.get( 'pageSize', 50 ) )
+			start = int( query.get( 'pageFromKey', 0 ) )
+			answer = { 'items': endpoints[ start:start + size ], 'pages': { 'size': size } }
+			if start + size < len( endpoints ):
+				answer['pages']['nextKey'] = str( start + size )
+			if query.get( 'pageTotal' ) == 'true':
+				answer['pages']['items'] = len( endpoints )
+			return 200, answer
+		if path.startswith( '/common/' ) and path.endswith( '/v1/alerts' ):
+			return 200, { 'items': self.alerts, 'pages': { 'items': len( self.alerts ) } }
+		return 404, { 'error': 'not found' }
+
+#-----------------------------------------------------------------------
+# Cisco Meraki dashboard
+#-----------------------------------------------------------------------
+class Meraki( Appliance ):
+	tls = False
+	rate = 10
+	products = [ 'switch', 'switch', 'wireless', 'wireless', 'wireless', 'appliance' ]
+
+	def build( self ):
+		n = self.scale
+		self.base = None        # set by serve()
+		self.lock = threading.Lock()
+		self.tokens, self.stamp, self.rejected = self.rate, time.monotonic(), 0
+		self.devices = []
+		for i in range(n):
+			product = self.products[ i % len( self.products ) ]
+			self.devices.append( { 'serial': 'Q2XX-{:04d}-{:04d}'.format( i // 10000, i % 10000 ),
+				'name': '{} {}'.format( product, i ), 'networkId': 'N_{:05d}'.format( i // 20 ),
+				'productType': product, 'model': { 'switch': 'MS225-48', 'wireless': 'MR46',
+				'appliance': 'MX68' }[product], 'mac': 'e0:55:3d:{:02x}:{:02x}:{:02x}'.format(
+				i >> 16 & 255, i >> 8 & 255, i & 255 ), 'lanIp': '10.{}.{}.{}'.format( i >> 16 & 255,
+				i >> 8 & 255, i & 255 ), 'firmware': 'bench-1' } )
+		self.by_serial = { d['serial']: d for d in self.devices }
+		self.index = { d['serial']: i for i, d in enumerate( self.devices ) }
+		self.statuses = [ { 'serial': d['serial'], 'networkId': d['networkId'], 'name': d['name'],
+			'status': 'offline' if i % 37 == 5 else 'online', 'lastReportedAt': _iso( 1.7e9 ),
+			'lanIp': d['lanIp'], 'productType': d['productType'] } for i, d in enumerate( self.devices ) ]
+		self.alerts = {}
+		for i, d in enumerate( self.devices ):
+			if i % 37 == 5:
+				alert = ( 'Connectivity', 'Unreachable device', 'warning' )
+			elif i % 41 == 7:
+				alert = ( 'Configuration', 'DFS event pattern', 'info' )
+			else:
+				continue
+			self.alerts.setdefault( d['networkId'], [] ).append( { 'id': '', 'category': alert[0],
+				'type': alert[1], 'severity': alert[2], 'scope': { 'devices': [ { 'url':
+				'https://n121.meraki.com/bench/n/x/manage/nodes/new_list/{}'.format(i), 'name': d['name'],
+				'productType': d['productType'], 'serial': d['serial'], 'mac': d['mac'] } ],
+				'applications': [], 'peers': [] } } )
+
+	def ports( self, serial ):
+		i = self.index[serial]
+		return [ { 'portId': str(p), 'enabled': True, 'status': 'Connected' if p % 3 else 'Disconnected',
+			'errors': [ 'CRC align errors' ] if ( i + p ) % 23 == 0 else [],
+			'warnings': [], 'speed': '1 Gbps', 'duplex': 'full' } for p in range( 1, 49 ) ]
+
+	def throttle( self ):
+		"""seconds to wait if the organization is over its rate, else None"""
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min( self.rate, self.tokens + ( now - self.stamp ) * self.rate )
+			self.stamp = now
+			if self.tokens < 1:
+				self.rejected += 1
+				return max( 1, round( ( 1 - self.tokens ) / self.rate ) )
+			self.tokens -= 1
+
+	def page( self, path, items, query, key='serial', default=1000 ):
+		size = int( query.get( 'perPage', default ) )
+		start = 0
+		if query.get( 'startingAfter' ):
+			start = next( ( n + 1 for n, item in enumerate( items ) if item[key] == query['startingAfter'] ),
+				len( items ) )
+		chunk = items[ start:start + size ]
+		headers = {}
+		if start + size < len( items ):
+			q = dict( query, startingAfter=chunk[-1][key] )
+			headers['Link'] = '<{}{}?{}>; rel=next'.format( self.base, path, urlencode( q ) )
+		return chunk, headers
+
+	def route( self, method, path, query, body, headers ):
+		if headers.get( 'X-Cisco-Meraki-API-Key' ) != 'bench':
+			return 401, { 'errors': [ 'Invalid API key' ] }
+		wait = self.throttle()
+		if wait:
+			return 429, { 'errors': [ 'API rate limit exceeded for organization' ] }, { 'Retry-After': str( wait ) }
+		parts = path.split( '/' )[ 3: ]     # after /api/v1
+		if parts == [ 'organizations' ]:
+			return 200, [ { 'id': '1000', 'name': 'Bench Organization', 'url': self.base } ]
+		if parts[ :2 ] == [ 'organizations', '1000' ]:
+			rest = '/'.join( parts[ 2: ] )
+			if rest == 'devices':
+				items, links = self.page( path, self.devices, query )
+				return 200, items, links
+			if rest == 'devices/statuses':
+				items, links = self.page( path, self.statuses, query )
+				return 200, items, links
+			if rest == 'devices/uplinksLossAndLatency':
+				return 200, [ { 'networkId': d['networkId'], 'serial': d['serial'], 'uplink': 'wan1',
+					'ip': '8.8.8.8', 'timeSeries': [ { 'ts': _iso( 1.7e9 + t * 60 ), 'lossPercent': 0.0,
+					'latencyMs': 12.5 + t } for t in range( 5 ) ] }
+					for d in self.devices if d['productType'] == 'appliance' ]
+			if rest == 'switch/ports/statuses/bySwitch':
+				if int( query.get( 'perPage', 10 ) ) > 20:
+					return 400, { 'errors': [ "'perPage' must be less than or equal to 20" ] }
+				switches = [ d for d in self.devices if d['productType'] == 'switch' ]
+				items, links = self.page( path, switches, query, default=10 )
+				return 200, { 'items': [ { 'serial': d['serial'], 'name': d['name'], 'model': d['model'],
+					'network': { 'id': d['networkId'] }, 'ports': self.ports( d['serial'] ) } for d in items ],
+					'meta': { 'counts': { 'items': { 'total': len( switches ) } } } }, links
+		if len( parts ) == 4 and parts[0] == 'networks' and parts[2:] == [ 'health', 'alerts' ]:
+			return 200, self.alerts.get( parts[1], [] )
+		if parts[ :1 ] == [ 'devices' ] and len( parts ) > 1 and parts[1] in self.by_serial:
+			if len( parts ) == 2:
+				return 200, self.by_serial[ parts[1] ]
+			if parts[2:] == [ 'switch', 'ports', 'statuses' ] and self.by_serial[ parts[1] ]['productType'] == 'switch':
+				return 200, self.ports( parts[1] )
+		return 404, { 'errors': [ 'Not found' ] }
+
+#-----------------------------------------------------------------------
+# Icinga 2 API (passive results)
+#-----------------------------------------------------------------------
+class Icinga( Appliance ):
+	"""'scale' is ignored; user and password are 'bench'"""
+	def build( self ):
+		self.lock = threading.Lock()
+		self.results = []
+
+	def route( self, method, path, query, body, headers ):
+		import base64
+		if headers.get( 'Authorization' ) != 'Basic ' + base64.b64encode( b'bench:bench' ).decode():
+			return 401, { 'error': 401, 'status': 'Unauthorized. Please check your user credentials.' }
+		if method != 'POST' or path != '/v1/actions/process-check-result':
+			return 404, { 'error': 404, 'status': 'The requested path could not be found.' }
+		data = json.loads( body or b'{}' )
+		with self.lock:
+			self.results.append( data )
+		name = '{}!{}'.format( data['filter_vars']['hostname'], data['filter_vars']['servicename'] )
+		return 200, { 'results': [ { 'code': 200,
+			'status': "Successfully processed check result for object '{}'.".format( name ) } ] }
+
+#-----------------------------------------------------------------------
+# Telegram bot API
+#-----------------------------------------------------------------------
+class Telegram( Appliance ):
+	"""'scale' is ignored; more than one message per 'interval' and chat gets a 429"""
+	tls = False
+	interval = 1.0
+
+	def build( self ):
+		self.lock = threading.Lock()
+		self.last = {}
+		self.messages = []
+		self.rejected = 0
+
+	def route( self, method, path, query, body, headers ):
+		parts = path.split( '/' )
+		if method != 'POST' or len( parts ) != 3 or not parts[1].startswith( 'bot' ) \
+				or parts[2] != 'sendMessage':
+			return 404, { 'ok': False, 'error_code': 404, 'description': 'Not Found' }
+		form = { k: v[-1] for k, v in parse_qs( body.decode() ).items() }
+		if not form.get( 'chat_id' ) or not form.get( 'text' ):
+			return 400, { 'ok': False, 'error_code': 400, 'description': 'Bad Request: message text is empty' }
+		with self.lock:
+			now = time.monotonic()
+			wait = self.last.get( form['chat_id'], -self.interval ) + self.interval - now
+			if wait > 0:
+				self.rejected += 1
+				retry = max( 1, round( wait ) )
+				return 429, { 'ok': False, 'error_code': 429,
+					'description': 'Too Many Requests: retry after {}'.format( retry ),
+					'parameters': { 'retry_after': retry } }, { 'Retry-After': str( retry ) }
+			self.last[ form['chat_id'] ] = now
+			self.messages.append( form )
+			return 200, { 'ok': True, 'result': { 'message_id': len( self.messages ),
+				'chat': { 'id': form['chat_id'] }, 'text': form['text'] } }
+
+APPLIANCES = {
+	'ontap':      Ontap,
+	'fortigate':  Fortigate,
+	'veeam':      Veeam,
+	'hpe':        Hpe,
+	'powervault': Powervault,
+	'sophos':     Sophos,
+	'meraki':     Meraki,
+	'icinga':     Icinga,
+	'telegram':   Telegram,
+	}
+
+#-----------------------------------------------------------------------
+# Server
+#-----------------------------------------------------------------------
+class _Handler( BaseHTTPRequestHandler ):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message( self, *args ):
+		pass
+
+	def _handle( self ):
+		server = self.server
+		length = int( self.headers.get( 'Content-Length', 0 ) )
+		body = self.rfile.read( length ) if length else b''
+		bytes_in = len( self.raw_requestline ) + len( bytes( self.headers ) ) + len( body )
+
+		url = urlsplit( self.path )
+		query = { k: v[-1] for k, v in parse_qs( url.query ).items() }
+		if server.latency:
+			time.sleep( server.latency )
+		# (status, answer) or (status, answer, extra headers)
+		status, answer, *extra = server.appliance.route( self.command, url.path, query, body, self.headers )
+
+		data = json.dumps( answer ).encode()
+		self.send_response( status )
+		self.send_header( 'Content-Type', 'application/json' )
+		for name, value in ( extra[0] if extra else {} ).items():
+			self.send_header( name, value )
+		if len( data ) > GZIP_MIN and 'gzip' in self.headers.get( 'Accept-Encoding', '' ):
+			data = gzip.compress( data, 5 )
+			self.send_header( 'Content-Encoding', 'gzip' )
+		self.send_header( 'Content-Length', str( len( data ) ) )
+		self.end_headers()
+		self.wfile.write( data )
+		# status line and headers are about 150 bytes
+		server.stats.count( bytes_in, len( data ) + 150 )
+
+	do_GET = do_POST = do_DELETE = do_PUT = _handle
+
+class ApplianceServer( ThreadingHTTPServer ):
+	daemon_threads = True
+
+	def __init__( self, appliance, latency, certdir ):
+		super().__init__( ( '127.0.0.1', appliance.port ), _Handler )
+		self.appliance = appliance
+		self.latency   = latency
+		self.stats     = Stats()
+		self.port      = self.server_address[1]
+		if appliance.tls:
+			ctx = ssl.SSLContext( ssl.PROTOCOL_TLS_SERVER )
+			ctx.load_cert_chain( *make_cert( certdir ) )
+			self.socket = ctx.wrap_socket( self.socket, server_side=True )
+		scheme = 'https' if appliance.tls else 'http'
+		self.url = '{}://127.0.0.1:{}'.format( scheme, self.port )
+		appliance.base = self.url
+
+def serve( name, scale, latency, certdir ):
+	"""start appliance 'name' in a background thread; returns the server"""
+	server = ApplianceServer( APPLIANCES[name]( scale ), latency, certdir )
+	threading.Thread( target=server.serve_forever, daemon=True ).start()
+	return server
+
+#-----------------------------------------------------------------------
+# SMTP
+#-----------------------------------------------------------------------
+class _SmtpHandler( socketserver.StreamRequestHandler ):
+	"""just enough SMTP for smtplib: EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP, QUIT"""
+	def reply( self, text ):
+		self.wfile.write( text.encode() + b'\r\n' )
+
+	def handle( self ):
+		server = self.server
+		server.stats.count( 0, 0 )
+		with server.lock:
+			server.connections += 1
+		self.reply( '220 127.0.0.1 bench ESMTP' )
+		sender, recipients = None, []
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				return
+			command = line.decode( errors='replace' ).strip()
+			verb = command[ :4 ].upper()
+			if verb == 'EHLO':
+				self.reply( '250-127.0.0.1\r\n250 8BITMIME' )
+			elif verb == 'HELO' or verb == 'NOOP':
+				self.reply( '250 OK' )
+			elif verb == 'MAIL':
+				sender, recipients = command[ 10: ].strip( '<> ' ), []
+				self.reply( '250 OK' )
+			elif verb == 'RCPT':
+				recipients.append( command[ 8: ].strip( '<> ' ) )
+				self.reply( '250 OK' )
+			elif verb == 'DATA':
+				self.reply( '354 End data with <CR><LF>.<CR><LF>' )
+				data = []
+				for line in self.rfile:
+					if line in ( b'.\r\n', b'.\n' ):
+						break
+					data.append( line[1:] if line.startswith( b'..' ) else line )
+				if server.latency:
+					time.sleep( server.latency )
+				message = b''.join( data )
+				with server.lock:
+					server.messages.append( { 'from': sender, 'to': recipients, 'data': message } )
+				server.stats.count( len( message ), 0 )
+				self.reply( '250 OK queued' )
+			elif verb == 'RSET':
+				sender, recipients = None, []
+				self.reply( '250 OK' )
+			elif verb == 'QUIT':
+				self.reply( '221 Bye' )
+				return
+			else:
+				self.reply( '502 Command not implemented' )
+
+class SmtpServer( socketserver.ThreadingTCPServer ):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__( self, latency ):
+		super().__init__( ( '127.0.0.1', 0 ), _SmtpHandler )
+		self.latency     = latency
+		self.stats       = Stats()
+		self.lock        = threading.Lock()
+		self.connections = 0
+		self.messages    = []
+		self.port        = self.server_address[1]
+
+def serve_smtp( latency=0 ):
+	"""start the SMTP stand-in in a background thread; returns the server"""
+	server = SmtpServer( latency )
+	threading.Thread( target=server.serve_forever, daemon=True ).start()
+	return server
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,127 @@
+"""on-disk response cache shared by check-plugins running against the same device."""
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+
+CACHE_DIR      = '/var/tmp/check-plugins/cache'
+# upper bound for the size of all cached responses (bytes)
+CACHE_MAXSIZE  = 64 * 1024**2
+# how long to wait for another check fetching the same response (seconds)
+CACHE_LOCKWAIT = 30
+
+def fingerprint( credential ):
+	"""hash a credential (token, password, (user, password)) for use in file names"""
+	if isinstance( credential, (tuple, list) ):
+		credential = '\0'.join( str(c) for c in credential )
+	return hashlib.sha256( str(credential).encode() ).hexdigest()
+
+def cache_key( url, credential ):
+	"""cache key from host and endpoint (both part of 'url') and credential"""
+	key = '\0'.join( [ url, fingerprint( credential ) ] )
+	return hashlib.sha256( key.encode() ).hexdigest()
+
+def _read_fresh( path, ttl ):
+	try:
+		if time.time() - os.stat( path ).st_mtime > ttl:
+			return None
+		with open( path, 'r', encoding='utf-8' ) as fh:
+			return json.load( fh )
+	except (OSError, ValueError):
+		return None
+
+def write_atomic( path, data, mode='w' ):
+	"""write 'data' to a temporary file and rename it to 'path'"""
+	fd, tmp = tempfile.mkstemp( dir=os.path.dirname( path ), prefix='.tmp-' )
+	try:
+		with os.fdopen( fd, mode ) as fh:
+			fh.write( data )
+		os.replace( tmp, path )
+	except BaseException:
+		os.unlink( tmp )
+		raise
+
+def lock_file( path, wait ):
+	"""exclusive lock on 'path'; returns the locked file or None after 'wait' seconds"""
+	fh = open( path, 'a' )
+	deadline = time.time() + wait
+	while True:
+		try:
+			fcntl.flock( fh, fcntl.LOCK_EX | fcntl.LOCK_NB )
+			return fh
+		except BlockingIOError:
+			if time.time() > deadline:
+				fh.close()
+				return None
+			time.sleep( 0.1 )
+
+def evict( cachedir, maxsize ):
+	"""remove the oldest responses until the cache is smaller than 'maxsize'"""
+	entries = []
+	total = 0
+	with os.scandir( cachedir ) as it:
+		for entry in it:
+			if not entry.name.endswith( '.json' ):
+				continue
+			try:
+				st = entry.stat()
+			except OSError:
+				continue
+			entries.append( ( st.st_mtime, st.st_size, entry.path ) )
+			total += st.st_size
+
+	for mtime, size, path in sorted( entries ):
+		if total <= maxsize:
+			break
+		# the lock file stays: a check waiting for it or holding it would
+		# lock a file no longer reachable by the others
+		try:
+			os.unlink( path )
+		except OSError:
+			pass
+		total -= size
+
+def cached_json( url, credential, fetch, ttl, cachedir=None, wait=None ):
+	"""return the cached answer for 'url', calling 'fetch()' when outdated
+
+	'fetch' must return JSON serializable data. When several checks ask for
+	the same response at once, one of them fetches it while the others wait
+	for the lock (up to 'wait' seconds, default CACHE_LOCKWAIT) and reuse
+	the result. If the cache directory is not usable, 'fetch()' is called
+	directly.
+	"""
+	cachedir = cachedir or CACHE_DIR
+	key = cache_key( url, credential )
+	path = os.path.join( cachedir, key + '.json' )
+
+	result = _read_fresh( path, ttl )
+	if result is not None:
+		return result
+
+	try:
+		os.makedirs( cachedir, mode=0o700, exist_ok=True )
+		lock = lock_file( os.path.join( cachedir, key + '.lock' ), CACHE_LOCKWAIT if wait is None else wait )
+	except OSError:
+		return fetch()
+
+	try:
+		# someone else might have fetched it while we were waiting
+		result = _read_fresh( path, ttl )
+		if result is not None:
+			return result
+
+		result = fetch()
+		try:
+			write_atomic( path, json.dumps( result ) )
+			evict( cachedir, CACHE_MAXSIZE )
+		except (OSError, TypeError, ValueError):
+			pass
+		return result
+	finally:
+		if lock:
+			lock.close()
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,115 @@
+"""counter store for check-plugins: rates from monotonically increasing counters.
+
+Every host gets one state file holding the last value and timestamp of
+all its counters. The file is a fixed-size header followed by records
+sorted by key hash, so it can be memory-mapped and read in one pass even
+with thousands of counters:
+
+	header: b'CNT1', number of records          (struct '<4sI')
+	record: key hash, counter value, timestamp  (struct '<QQd')
+
+Keys are strings chosen by the plugin, e.g. 'vol/svm1/vol0/iops/read'.
+"""
+
+import os
+import mmap
+import time
+import struct
+import hashlib
+from lib.cache import lock_file, write_atomic
+
+COUNTER_DIR      = '/var/tmp/check-plugins/counters'
+# counters not updated for this many seconds are dropped
+COUNTER_EXPIRE   = 7 * 24 * 60**2
+# how long to wait for another check updating the same host
+COUNTER_LOCKWAIT = 30
+
+_HEADER = struct.Struct( '<4sI' )
+_RECORD = struct.Struct( '<QQd' )
+_MAGIC  = b'CNT1'
+
+def key_hash( key ):
+	"""64 bit hash of a counter key"""
+	return int.from_bytes( hashlib.blake2b( key.encode(), digest_size=8 ).digest(), 'little' )
+
+def read_counters( path ):
+	"""return {key hash: (value, timestamp)} of a state file, {} if unusable"""
+	try:
+		with open( path, 'rb' ) as fh:
+			with mmap.mmap( fh.fileno(), 0, access=mmap.ACCESS_READ ) as mm:
+				magic, count = _HEADER.unpack_from( mm )
+				if magic != _MAGIC or len(mm) != _HEADER.size + count * _RECORD.size:
+					return {}
+				return { h: ( value, ts ) for h, value, ts in
+						_RECORD.iter_unpack( mm[ _HEADER.size: ] ) }
+	except (OSError, ValueError, struct.error):
+		return {}
+
+def write_counters( path, counters ):
+	"""write {key hash: (value, timestamp)} atomically"""
+	records = b''.join( _RECORD.pack( h, value, ts )
+					for h, ( value, ts ) in sorted( counters.items() ) )
+	write_atomic( path, _HEADER.pack( _MAGIC, len(counters) ) + records, 'wb' )
+
+def _rate( old, value, ts, bits ):
+	"""per second rate between the stored sample 'old' and (value, ts)
+
+	None when there is no usable previous sample: first run, no time passed,
+	or the counter was reset. A counter of 'bits' width that was close to its
+	maximum is taken as wrapped.
+	"""
+	if old is None:
+		return None
+	old_value, old_ts = old
+	elapsed = ts - old_ts
+	if elapsed <= 0:
+		return None
+
+	delta = value - old_value
+	if delta < 0:
+		if bits and old_value > ( 2**bits ) * 3 // 4:
+			delta += 2**bits
+		else:
+			return None
+	return delta / elapsed
+
+def counter_rates( host, samples, statedir=None, bits=64 ):
+	"""update the counters of 'host' and return their rates
+
+	'samples' maps counter keys to (value, timestamp); the timestamp should
+	come from the device if it has one, time.time() otherwise. Returns
+	{key: rate per second or None}. Samples without a newer timestamp than
+	the stored one leave the stored sample untouched.
+	"""
+	statedir = statedir or COUNTER_DIR
+	path = os.path.join( statedir, host.replace( '/', '_' ) + '.counters' )
+
+	try:
+		os.makedirs( statedir, mode=0o700, exist_ok=True )
+		lock = lock_file( path + '.lock', COUNTER_LOCKWAIT )
+	except OSError:
+		lock = None
+
+	try:
+		counters = read_counters( path )
+		rates = {}
+		for key, ( value, ts ) in samples.items():
+			h = key_hash( key )
+			old = counters.get( h )
+			rates[key] = _rate( old, value, ts, bits )
+			if old is None or ts > old[1]:
+				# values beyond 64 bit cannot be stored; treat them as reset
+				counters[h] = ( value % 2**64, ts )
+
+		expire = time.time() - COUNTER_EXPIRE
+		counters = { h: c for h, c in counters.items() if c[1] >= expire }
+		try:
+			write_counters( path, counters )
+		except OSError:
+			pass
+		return rates
+	finally:
+		if lock:
+			lock.close()
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
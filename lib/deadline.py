@@ -0,0 +1,98 @@
+"""time budget of a check.
+
+Icinga kills a plugin that runs longer than the check timeout and reports
+a bare UNKNOWN without any detail. Plugins therefore set a deadline a bit
+before that (--deadline), every request gets only the time that is left
+(lib/jsonapi, lib/httpjson), and work not started before the deadline is
+skipped and reported as "N objects not evaluated":
+
+	deadline.start( args.deadline )
+	for obj in objects:
+		if deadline.expired():
+			result.add( 3, '{} objects not evaluated'.format( ... ) )
+			break
+		...
+
+The default deadline is taken from the environment variable CHECK_TIMEOUT
+(the check timeout in seconds, e.g. set in the 'env' of the CheckCommand)
+or the Icinga default of 60 seconds, minus DEADLINE_MARGIN for printing
+the result.
+"""
+
+import os
+import time
+import threading
+
+# Icinga 2 default of check_timeout
+CHECK_TIMEOUT   = 60
+# part of the check timeout kept for printing the result (at least 1s)
+DEADLINE_MARGIN = 0.1
+
+class DeadlineExceeded( TimeoutError ):
+	"""the deadline of the check has passed"""
+
+# end of the budget (time.monotonic()), per check in the check runner
+_process = { 'end': None }
+_local = threading.local()
+
+def default_deadline():
+	"""seconds from now to the default deadline"""
+	try:
+		timeout = float( os.environ.get( 'CHECK_TIMEOUT', CHECK_TIMEOUT ) )
+	except ValueError:
+		timeout = CHECK_TIMEOUT
+	return max( timeout - max( timeout * DEADLINE_MARGIN, 1 ), 1 )
+
+def _state():
+	return getattr( _local, 'state', None ) or _process
+
+def begin():
+	"""give the check running in this thread its own deadline (check runner)"""
+	_local.state = { 'end': None }
+
+def end():
+	_local.state = None
+
+def start( seconds ):
+	"""set the deadline 'seconds' from now; 0 or None: no deadline"""
+	_state()['end'] = time.monotonic() + seconds if seconds else None
+
+def remaining():
+	"""seconds left, None without a deadline"""
+	end = _state()['end']
+	return None if end is None else max( end - time.monotonic(), 0 )
+
+def expired():
+	return remaining() == 0
+
+def timeout( default ):
+	"""'default' (seconds or (connect, read)) cut to the remaining time
+
+	Raises DeadlineExceeded if no time is left.
+	"""
+	left = remaining()
+	if left is None:
+		return default
+	if left == 0:
+		raise DeadlineExceeded( 'deadline of the check reached' )
+	if isinstance( default, tuple ):
+		return tuple( min( t, left ) for t in default )
+	return min( default, left ) if default else left
+
+def bind( func ):
+	"""'func' running with the deadline of the calling thread, for worker threads"""
+	state = _state()
+	def run( *args, **kwargs ):
+		outer = getattr( _local, 'state', None )
+		_local.state = state
+		try:
+			return func( *args, **kwargs )
+		finally:
+			_local.state = outer
+	return run
+
+def not_evaluated( count, what='objects' ):
+	"""text for the UNKNOWN part about skipped work"""
+	return '{} {} not evaluated (deadline reached)'.format( count, what )
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,152 @@
+"""run one check mode against every host of an inventory, in one process.
+
+	check_fleet hosts.csv firewall/fortigate -H {host} --token {token} --mode version
+
+The inventory is a CSV file with a header line, one host per row; its
+columns fill the {placeholders} of the plugin arguments. Empty lines and
+lines starting with '#' are skipped. The plugin is run by lib/runner in
+threads of this process, as in the check runner: it is compiled once,
+and the modules, connection pools and caches of lib.* are shared by all
+hosts instead of being loaded by one interpreter per host.
+
+Rows are read while the checks run, at most 'workers' hosts are checked
+at the same time and every result is handed on as soon as it is there,
+so memory does not grow with the size of the inventory. Every host gets
+'timeout' seconds: the plugins take it as their deadline (CHECK_TIMEOUT,
+see lib/deadline); a host still running FLEET_GRACE seconds after it is
+reported UNKNOWN and left behind.
+"""
+
+import os
+import csv
+import time
+import queue
+import threading
+from lib import runner
+
+FLEET_WORKERS = 32
+# seconds per host
+FLEET_TIMEOUT = 30
+# seconds a host may run over its timeout before it is given up
+FLEET_GRACE   = 5
+# distinct outputs counted in the summary, the rest is counted as 'other'
+FLEET_GROUPS  = 20
+
+STATES = [ 'OK', 'WARNING', 'CRITICAL', 'UNKNOWN' ]
+
+def read_inventory( fh ):
+	"""rows of a CSV inventory as dicts, without comments and empty lines"""
+	lines = ( line for line in fh if line.strip() and not line.lstrip().startswith( '#' ) )
+	for row in csv.DictReader( lines ):
+		yield { key.strip(): ( value or '' ).strip() for key, value in row.items() if key }
+
+def host_label( row, n ):
+	return row.get( 'name' ) or row.get( 'host' ) or 'row {}'.format( n )
+
+def run_host( plugin, argv, row, n, detail=False ):
+	"""run the plugin for one inventory row; returns the result dict"""
+	start = time.monotonic()
+	result = { 'host': host_label( row, n ) }
+	try:
+		rc, stdout, stderr = runner.run_plugin( plugin, [ arg.format_map( row ) for arg in argv ] )
+	except KeyError as e:
+		rc, stdout, stderr = 3, '(UNKNOWN) inventory has no column {}'.format( e ), ''
+	except (ValueError, IndexError) as e:
+		rc, stdout, stderr = 3, '(UNKNOWN) invalid placeholder in the plugin arguments: {}'.format( e ), ''
+	rc = rc if rc in ( 0, 1, 2, 3 ) else 3
+	result.update( rc=rc, state=STATES[rc], seconds=round( time.monotonic() - start, 3 ),
+		output=stdout.split( '\n', 1 )[0].split( '|', 1 )[0].strip() )
+	if detail:
+		result['detail'] = stdout.strip()
+	if stderr.strip() and rc:
+		result['stderr'] = stderr.strip()[ -1000: ]
+	return result
+
+class Summary:
+	"""counts of the results by state and by output, in constant memory"""
+	def __init__( self ):
+		self.start   = time.monotonic()
+		self.states  = dict.fromkeys( STATES, 0 )
+		self.groups  = {}
+		self.other   = 0
+		self.hosts   = 0
+		self.seconds = 0.0
+		self.slowest = ( 0.0, None )
+		self.rc      = 0
+
+	def add( self, result ):
+		self.hosts += 1
+		self.states[ result['state'] ] += 1
+		self.rc = max( self.rc, result['rc'] )
+		self.seconds += result['seconds']
+		if result['seconds'] >= self.slowest[0]:
+			self.slowest = ( result['seconds'], result['host'] )
+		# the text without the state: hosts with the same version, error, ...
+		text = result['output'].split( ' ', 1 )[-1]
+		key = ( result['state'], text )
+		if key in self.groups or len( self.groups ) < FLEET_GROUPS:
+			self.groups[key] = self.groups.get( key, 0 ) + 1
+		else:
+			self.other += 1
+
+	def table( self ):
+		wall = time.monotonic() - self.start
+		lines = [ '{:<10} {:>7}'.format( 'state', 'hosts' ) ]
+		lines += [ '{:<10} {:>7}'.format( state, count ) for state, count in self.states.items() ]
+		lines += [ '', '{:<10} {:>7}  {}'.format( 'state', 'hosts', 'output' ) ]
+		for ( state, text ), count in sorted( self.groups.items(), key=lambda x: ( -x[1], x[0] ) ):
+			lines.append( '{:<10} {:>7}  {}'.format( state, count, text[ :100 ] ) )
+		if self.other:
+			lines.append( '{:<10} {:>7}  {}'.format( '', self.other, '(other outputs)' ) )
+		lines += [ '', '{} hosts in {:.1f}s ({:.1f}/s), {:.2f}s per host, slowest: {} {:.2f}s'.format(
+			self.hosts, wall, self.hosts / wall if wall else 0, self.seconds / self.hosts if self.hosts else 0,
+			self.slowest[1], self.slowest[0] ) ]
+		return '\n'.join( lines )
+
+def run_fleet( rows, plugin, argv, emit, workers=FLEET_WORKERS, timeout=FLEET_TIMEOUT, detail=False ):
+	"""run 'plugin argv' for every inventory row, call emit( result ) for each; returns the Summary"""
+	runner.install()
+	os.environ['CHECK_TIMEOUT'] = '{:g}'.format( timeout )
+	summary = Summary()
+	results = queue.Queue()
+	running = {}    # row number: (label, start)
+	rows = enumerate( rows, 1 )
+	more = True
+
+	def task( n, row ):
+		results.put( ( n, run_host( plugin, argv, row, n, detail ) ) )
+
+	def done( n, result ):
+		del running[n]
+		summary.add( result )
+		emit( result )
+
+	while more or running:
+		while more and len( running ) < workers:
+			item = next( rows, None )
+			if item is None:
+				more = False
+				break
+			n, row = item
+			running[n] = ( host_label( row, n ), time.monotonic() )
+			threading.Thread( target=task, args=( n, row ), daemon=True ).start()
+		if not running:
+			break
+
+		oldest = min( start for label, start in running.values() )
+		try:
+			n, result = results.get( timeout=max( oldest + timeout + FLEET_GRACE - time.monotonic(), 0.01 ) )
+			# results of hosts given up are dropped
+			if n in running:
+				done( n, result )
+		except queue.Empty:
+			pass
+
+		now = time.monotonic()
+		for n, ( label, start ) in list( running.items() ):
+			if now - start > timeout + FLEET_GRACE:
+				done( n, { 'host': label, 'rc': 3, 'state': 'UNKNOWN', 'seconds': round( now - start, 3 ),
+					'output': '(UNKNOWN) no result after {:g}s, given up'.format( timeout + FLEET_GRACE ) } )
+	return summary
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -1,5 +1,11 @@
 """common functions for check-plugins"""
 import sys
+from lib import instrument
+
+# default size limit for the detail output of CheckResult (bytes); long
+# outputs are cut by Icinga and its database backends anyway
+DETAIL_BUDGET = 16 * 1024
+
 def rcstring( rc, b='(', lineup=0 ):
     brace = {
             '(': [ '(', ')' ],
@@ -54,6 +60,9 @@ def update_rc( new, old ):
         return( old )
 
 def plugin_output( rc, msg, detail, perfdata ):
+    if instrument.ENABLED:
+        perfdata = ' '.join( p for p in [ ( perfdata or '' ).strip(), instrument.perfdata() ] if p )
+        instrument.write_trace()
     outstr = ' '.join( [ rcstring(rc), msg ] )
     if detail:
         outstr+="\n\n" + detail
@@ -65,3 +74,146 @@ def output_and_exit( rc, msg, detail, perfdata ):
     print( plugin_output( rc, msg, detail, perfdata ) )
     sys.exit(rc)
 
+
+def perf_label( label ):
+    """quote a perfdata label if needed; single quotes are doubled, '=' is not allowed"""
+    label = str( label ).replace( '=', '_' )
+    if "'" in label or any( c.isspace() for c in label ):
+        return "'{}'".format( label.replace( "'", "''" ) )
+    return label
+
+def perf_value( value ):
+    if value is None:
+        return ''
+    if isinstance( value, float ):
+        if value.is_integer():
+            return str( int( value ) )
+        # no scientific notation, not all graphers understand it
+        return '{:.6f}'.format( value ).rstrip( '0' ).rstrip( '.' )
+    return str( value )
+
+class CheckResult:
+    """collects state, detail rows and perfdata of one check
+
+    Rows and perfdata are kept as tuples and only turned into text by
+    render(), in one pass. The overall state is merged while rows are
+    added. If the detail text does not fit into 'budget' bytes, the rows
+    with the worst state are kept (in their original order) and the others
+    are summarized in a last line.
+
+        result = CheckResult()
+        result.note( 'Volumes' )
+        for vol in vols:
+            result.add( rc, '{}: {:.1f}% used'.format( name, used ) )
+            result.perf( name, used, '%', warn, crit, 0, 100 )
+        result.exit( 'Checked {} volumes'.format( len(vols) ), budget=8000 )
+
+    Values of many objects can go to a metrics sink (lib/metrics) with
+    metric(); of these, the perfdata only keeps the 'perf_max' objects
+    ranked highest, with all their values. An object ('obj', default: the
+    label) ranks by the worst state of its values, then by the highest of
+    its values added with 'rank=True'; values in other units (e.g. IOPS
+    beside a latency) are added with 'rank=False'. Values added with
+    perf() (summaries) are always in the perfdata.
+    """
+    def __init__( self, rc=0, fmt='{state} {text}', lineup=1, brace='(', sink=None, perf_max=None ):
+        self.rc       = rc
+        self.fmt      = fmt
+        self.lineup   = lineup
+        self.brace    = brace
+        self.sink     = sink
+        self.perf_max = perf_max
+        self.rows     = []      # (rc or None for plain lines, text)
+        self.perfdata = []      # (label, value, uom, warn, crit, min, max)
+        self.objects  = []      # (object, ranks, perfdata tuple) from metric()
+
+    def update( self, rc ):
+        self.rc = update_rc( rc, self.rc )
+        return self.rc
+
+    def add( self, rc, text, merge=True ):
+        """detail row with state; 'merge=False' shows the state without changing the overall state"""
+        self.rows.append( ( rc, text ) )
+        if merge:
+            self.update( rc )
+
+    def note( self, text ):
+        """detail line without state (headings, empty lines)"""
+        self.rows.append( ( None, text ) )
+
+    def perf( self, label, value, uom='', warn=None, crit=None, min=None, max=None ):
+        self.perfdata.append( ( label, value, uom, warn, crit, min, max ) )
+
+    def metric( self, label, value, uom='', warn=None, crit=None, min=None, max=None, name=None, labels=None,
+                obj=None, rank=True ):
+        """value of object 'obj': to the sink as 'name' with 'labels', to the perfdata as 'label'"""
+        if self.sink is not None:
+            self.sink.add( name or label, value, uom, labels, warn, crit, min, max )
+        self.objects.append( ( obj or label, rank, ( label, value, uom, warn, crit, min, max ) ) )
+
+    def _line( self, rc, text ):
+        if rc is None:
+            return text
+        return self.fmt.format( state=rcstring( rc, self.brace, self.lineup ), text=text )
+
+    def render_detail( self, budget=None ):
+        lines = [ self._line( rc, text ) for rc, text in self.rows ]
+        if budget is None:
+            return '\n'.join( lines )
+
+        sizes = [ len( line.encode() ) + 1 for line in lines ]
+        if sum( sizes ) <= budget:
+            return '\n'.join( lines )
+
+        # fill the budget with the worst rows first: UNKNOWN, CRITICAL, WARNING, OK, plain lines
+        buckets = { 3: [], 2: [], 1: [], 0: [], None: [] }
+        for n, ( rc, text ) in enumerate( self.rows ):
+            buckets[ rc if rc in buckets else 3 ].append( n )
+
+        budget -= 80    # room for the summary line
+        keep = [ False ] * len( lines )
+        omitted = { 3: 0, 2: 0, 1: 0, 0: 0, None: 0 }
+        full = False
+        for rc in ( 3, 2, 1, 0, None ):
+            for n in buckets[rc]:
+                if not full and sizes[n] <= budget:
+                    keep[n] = True
+                    budget -= sizes[n]
+                else:
+                    full = True
+                    omitted[rc] += 1
+
+        summary = ', '.join( '{} {}'.format( omitted[rc], rcstring( rc, '(' )[1:-1] )
+                             for rc in ( 3, 2, 1, 0 ) if omitted[rc] )
+        lines = [ line for n, line in enumerate( lines ) if keep[n] ]
+        if summary:
+            lines.append( '... rows not shown: {}'.format( summary ) )
+        return '\n'.join( lines )
+
+    def _perf_objects( self ):
+        """the values of metric() kept in the perfdata, in their original order"""
+        groups = {}
+        for obj, ranks, perf in self.objects:
+            groups.setdefault( obj, [] ).append( ( ranks, perf ) )
+        if self.perf_max is None or len( groups ) <= self.perf_max:
+            return [ perf for obj, ranks, perf in self.objects ]
+
+        def rank( obj ):
+            state = max( check_threshold( perf[1], perf[3], perf[4] ) for ranks, perf in groups[obj] )
+            values = [ perf[1] for ranks, perf in groups[obj] if ranks and perf[1] is not None ]
+            return ( state, max( values ) if values else 0 )
+        keep = set( sorted( groups, key=rank, reverse=True )[ :self.perf_max ] )
+        return [ perf for obj, ranks, perf in self.objects if obj in keep ]
+
+    def render_perfdata( self ):
+        return ' '.join(
+            '{}={}{};{};{};{};{}'.format( perf_label( label ), perf_value( value ), uom,
+                perf_value( warn ), perf_value( crit ), perf_value( min ), perf_value( max ) ).rstrip( ';' )
+            for label, value, uom, warn, crit, min, max in self.perfdata + self._perf_objects() )
+
+    def render( self, msg, budget=None ):
+        return plugin_output( self.rc, msg, self.render_detail( budget ), self.render_perfdata() )
+
+    def exit( self, msg, budget=None ):
+        print( self.render( msg, budget ) )
+        sys.exit( self.rc )
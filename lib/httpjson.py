@@ -0,0 +1,209 @@
+"""minimal JSON-over-HTTP transport on http.client.
+
+For simple GET checks that do not need the features of 'requests'
+(sessions, auth helpers, proxies, multipart), importing requests and
+urllib3 is the largest part of the run time of a short check. This
+module only needs the standard library:
+
+	resp = get( 'https://fw01/api/v2/monitor/system/status',
+			headers={ 'Authorization': 'Bearer ...' } )
+	if resp:
+		data = resp.json()
+
+The answer offers the parts of requests.Response the plugins use:
+status_code, headers, content, text, json() and truth by status. Like
+lib/jsonapi, up to HTTP_POOLSIZE idle connections per host are kept open
+for the whole process: a thread takes one out for a request and puts it
+back afterwards, so checks run in threads of lib/runner or lib/fleet
+reuse the connections of earlier checks. Answers may be gzip
+compressed and GET requests are retried on connection errors and
+429/502/503/504 answers, as long as the deadline of the check
+(lib/deadline) leaves time for it. Proxies are not supported; get()
+falls back to lib/jsonapi when a proxy is configured in the environment.
+"""
+
+import os
+import json
+import time
+import zlib
+import threading
+import http.client
+from urllib.parse import urlsplit
+from lib import instrument, deadline
+
+# same defaults as lib/jsonapi
+HTTP_TIMEOUT     = (5, 30)
+HTTP_RETRIES     = 3
+HTTP_BACKOFF     = 0.5
+HTTP_BACKOFF_MAX = 10
+HTTP_POOLSIZE    = 4
+
+_RETRY_STATUS = ( 429, 502, 503, 504 )
+# a kept-alive connection closed by the server shows up as one of these
+_STALE = ( http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError )
+
+# (scheme, netloc, verify): idle kept-alive connections
+_pool = {}
+_pool_lock = threading.Lock()
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+class Response:
+	"""the parts of requests.Response used by the plugins"""
+	def __init__( self, url, status_code, reason, headers, content ):
+		self.url         = url
+		self.status_code = status_code
+		self.reason      = reason
+		self.headers     = headers
+		self.content     = content
+
+	@property
+	def ok( self ):
+		return self.status_code < 400
+
+	def __bool__( self ):
+		return self.ok
+
+	@property
+	def text( self ):
+		return self.content.decode( 'utf-8', errors='replace' )
+
+	def json( self ):
+		return json.loads( self.content )
+
+def _proxied( scheme ):
+	return any( os.environ.get( name ) for name in
+		( scheme + '_proxy', scheme.upper() + '_PROXY', 'all_proxy', 'ALL_PROXY' ) )
+
+def _ssl_context( verify ):
+	"""SSL context for 'verify', created once per process: loading the CA
+	store takes longer than a request (check_fleet opens many connections)"""
+	with _contexts_lock:
+		context = _contexts.get( verify )
+		if context is None:
+			context = _contexts[verify] = _new_context( verify )
+		return context
+
+def _new_context( verify ):
+	import ssl
+	if verify is False:
+		context = ssl.create_default_context()
+		context.check_hostname = False
+		context.verify_mode = ssl.CERT_NONE
+		return context
+	if isinstance( verify, str ):
+		return ssl.create_default_context( cafile=verify )
+	return ssl.create_default_context()
+
+def _connection( scheme, netloc, verify, timeout ):
+	"""an idle kept-alive connection to 'netloc' or a new one; (connection, reused)"""
+	key = ( scheme, netloc, verify )
+	with _pool_lock:
+		idle = _pool.get( key )
+		if idle:
+			return idle.pop(), True
+
+	if scheme == 'https':
+		conn = http.client.HTTPSConnection( netloc, timeout=timeout,
+			context=_ssl_context( verify ) )
+	else:
+		conn = http.client.HTTPConnection( netloc, timeout=timeout )
+	return conn, False
+
+def _release( key, conn ):
+	"""put 'conn' back for the next request, close it if enough are idle"""
+	with _pool_lock:
+		idle = _pool.setdefault( key, [] )
+		if len( idle ) < HTTP_POOLSIZE:
+			idle.append( conn )
+			return
+	conn.close()
+
+def _send( url, headers, timeout, verify ):
+	"""one GET request; stale kept-alive connections are replaced"""
+	parts = urlsplit( url )
+	target = parts.path or '/'
+	if parts.query:
+		target += '?' + parts.query
+	connect, read = timeout if isinstance( timeout, tuple ) else ( timeout, timeout )
+
+	key = ( parts.scheme, parts.netloc, verify )
+	while True:
+		conn, reused = _connection( parts.scheme, parts.netloc, verify, connect )
+		try:
+			if conn.sock is None:
+				conn.connect()
+			conn.sock.settimeout( read )
+			conn.request( 'GET', target, headers=headers )
+			resp = conn.getresponse()
+			content = resp.read()
+		except _STALE:
+			conn.close()
+			if reused:
+				continue
+			raise
+		except Exception:
+			conn.close()
+			raise
+		if resp.will_close:
+			conn.close()
+		else:
+			_release( key, conn )
+
+		encoding = resp.headers.get( 'Content-Encoding', '' ).lower()
+		if encoding in ( 'gzip', 'deflate' ):
+			content = zlib.decompress( content, 47 )
+		return Response( url, resp.status, resp.reason, resp.headers, content )
+
+def _backoff( attempt, resp ):
+	"""seconds to wait before retry number 'attempt'"""
+	if resp is not None:
+		try:
+			return min( float( resp.headers.get( 'Retry-After' ) ), HTTP_BACKOFF_MAX )
+		except (TypeError, ValueError):
+			pass
+	return min( HTTP_BACKOFF * 2 ** ( attempt - 1 ), HTTP_BACKOFF_MAX )
+
+def get( url, headers=None, timeout=None, verify=False, retries=None ):
+	"""GET 'url' and return a Response
+
+	'verify' is False (no certificate check, the default of the plugins),
+	True or the path of a CA bundle. 'retries' overrides HTTP_RETRIES, 0
+	for callers doing their own rate limiting. Raises OSError on connection
+	errors after the retries are used up.
+	"""
+	scheme = urlsplit( url ).scheme
+	if _proxied( scheme ):
+		from lib.jsonapi import http_request
+		return http_request( url, headers=headers, timeout=timeout, verify=verify )
+
+	headers = dict( headers or {} )
+	headers.setdefault( 'Accept-Encoding', 'gzip' )
+	headers.setdefault( 'User-Agent', 'check-plugins' )
+
+	retries = HTTP_RETRIES if retries is None else retries
+	start = time.monotonic()
+	attempt = 0
+	while True:
+		resp = error = None
+		try:
+			resp = _send( url, headers, deadline.timeout( timeout or HTTP_TIMEOUT ), verify )
+		except (OSError, http.client.HTTPException) as e:
+			error = e
+		if attempt >= retries or ( error is None and resp.status_code not in _RETRY_STATUS ):
+			break
+		attempt += 1
+		wait = _backoff( attempt, resp )
+		left = deadline.remaining()
+		if left is not None and wait >= left:
+			break
+		time.sleep( wait )
+
+	instrument.record( 'GET', url, None if resp is None else resp.status_code,
+		0 if resp is None else len( resp.content ), time.monotonic() - start, attempt,
+		repr( error ) if error else None )
+	if error is not None:
+		raise error if isinstance( error, OSError ) else OSError( repr( error ) )
+	return resp
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
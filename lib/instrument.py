@@ -0,0 +1,196 @@
+"""opt-in self-instrumentation for check-plugins.
+
+Switched on by the environment, so it can be enabled for all checks of a
+monitoring node at once (e.g. 'env' in the Icinga CheckCommand or the
+systemd unit of the check runner):
+
+	CHECK_INSTRUMENT=1		add perfdata about the check itself
+	CHECK_TRACE=<dir>		also write a trace, one JSON line per request,
+							to <dir>/<plugin>-<time>-<pid>.jsonl
+							(implies CHECK_INSTRUMENT)
+
+Perfdata added by plugin_output():
+
+	check_duration		since the start of the process (or of the check in
+						the check runner)
+	api_requests		HTTP requests sent through lib/jsonapi or lib/httpjson
+	api_time			sum of their durations; requests sent in parallel
+						can make this larger than check_duration
+	api_bytes			response bytes
+	login_time			time spent logging in (lib/session)
+	processing_time		check_duration without api_time
+
+Traces hold method, host, path (no query), status, bytes, seconds and
+retries of each request, never credentials or query strings.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import itertools
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+TRACE_DIR = os.environ.get( 'CHECK_TRACE' ) or None
+ENABLED   = bool( os.environ.get( 'CHECK_INSTRUMENT' ) ) or bool( TRACE_DIR )
+
+def _process_start():
+	"""time.monotonic() of the process start, interpreter startup included"""
+	try:
+		with open( '/proc/self/stat' ) as fh:
+			# fields after the command name; 'starttime' is field 22
+			ticks = int( fh.read().rpartition( ')' )[2].split()[19] )
+		with open( '/proc/uptime' ) as fh:
+			uptime = float( fh.read().split()[0] )
+		return time.monotonic() - max( uptime - ticks / os.sysconf( 'SC_CLK_TCK' ), 0 )
+	except (OSError, ValueError, IndexError):
+		return time.monotonic()
+
+class Recorder:
+	"""requests and phases of one check; single requests are kept for the trace only"""
+	def __init__( self, start=None ):
+		self.start    = start or time.monotonic()
+		self.lock     = threading.Lock()
+		self.count    = 0
+		self.seconds  = 0.0
+		self.bytes    = 0
+		self.requests = [] if TRACE_DIR else None
+		self.phases   = {}
+		self.traced   = False
+
+	def add( self, seconds, nbytes, entry=None ):
+		with self.lock:
+			self.count += 1
+			self.seconds += seconds
+			self.bytes += nbytes or 0
+			if self.requests is not None and entry is not None:
+				self.requests.append( entry )
+
+	def add_phase( self, name, seconds ):
+		with self.lock:
+			self.phases[name] = self.phases.get( name, 0 ) + seconds
+
+	def summary( self ):
+		with self.lock:
+			duration = time.monotonic() - self.start
+			return {
+				'check_duration':  duration,
+				'api_requests':    self.count,
+				'api_time':        self.seconds,
+				'api_bytes':       self.bytes,
+				'login_time':      self.phases.get( 'login', 0 ),
+				'processing_time': max( duration - self.seconds, 0 ),
+				}
+
+_process = Recorder( _process_start() )
+_local = threading.local()
+_checks = itertools.count( 1 )
+
+def current():
+	"""recorder of the check running in this thread
+
+	The check runner starts one per check (begin()). Worker threads of a
+	check record into its recorder when their function is bound to it
+	(bind()); otherwise they use the process-wide recorder.
+	"""
+	return getattr( _local, 'recorder', None ) or _process
+
+def bind( func ):
+	"""'func' recording into the recorder of the calling thread, for worker threads"""
+	recorder = current()
+	def run( *args, **kwargs ):
+		outer = getattr( _local, 'recorder', None )
+		_local.recorder = recorder
+		try:
+			return func( *args, **kwargs )
+		finally:
+			_local.recorder = outer
+	return run
+
+def begin():
+	"""start a new recorder for the check running in this thread"""
+	_local.recorder = Recorder()
+	return _local.recorder
+
+def end():
+	"""write the trace of the current check (if enabled) and drop its recorder"""
+	write_trace()
+	_local.recorder = None
+
+@contextmanager
+def phase( name ):
+	"""time a phase of the check; requests inside are tagged with 'name'"""
+	if not ENABLED:
+		yield
+		return
+	outer = getattr( _local, 'phase', None )
+	_local.phase = name
+	start = time.monotonic()
+	try:
+		yield
+	finally:
+		current().add_phase( name, time.monotonic() - start )
+		_local.phase = outer
+
+def record( method, url, status, nbytes, seconds, retries=0, error=None ):
+	"""note one HTTP request"""
+	if not ENABLED:
+		return
+	recorder = current()
+	if recorder.requests is None:
+		recorder.add( seconds, nbytes )
+		return
+	parts = urlsplit( url )
+	recorder.add( seconds, nbytes, {
+		't':       round( time.monotonic() - recorder.start - seconds, 6 ),
+		'phase':   getattr( _local, 'phase', None ),
+		'method':  method.upper(),
+		'host':    parts.netloc.rpartition( '@' )[2],
+		'path':    parts.path,
+		'status':  status,
+		'bytes':   nbytes,
+		'seconds': round( seconds, 6 ),
+		'retries': retries,
+		'error':   error,
+		} )
+
+def perfdata():
+	"""perfdata of the current check, '' if not enabled"""
+	if not ENABLED:
+		return ''
+	s = current().summary()
+	return ( "check_duration={check_duration:.3f}s api_requests={api_requests} "
+		"api_time={api_time:.3f}s api_bytes={api_bytes}B login_time={login_time:.3f}s "
+		"processing_time={processing_time:.3f}s" ).format( **s )
+
+def write_trace():
+	"""write the trace file of the current check once; errors are ignored"""
+	recorder = current()
+	if not TRACE_DIR or recorder.traced:
+		return
+	recorder.traced = True
+
+	plugin = os.path.basename( sys.argv[0] if sys.argv else '' ) or 'plugin'
+	name = '{}-{}-{}'.format( plugin, time.strftime( '%Y%m%dT%H%M%S' ), os.getpid() )
+	if recorder is not _process:
+		# the check runner runs many checks in one process
+		name += '-{}'.format( next( _checks ) )
+	path = os.path.join( TRACE_DIR, name + '.jsonl' )
+	try:
+		os.makedirs( TRACE_DIR, mode=0o700, exist_ok=True )
+		with recorder.lock:
+			requests = list( recorder.requests )
+		with open( path, 'a' ) as fh:
+			for entry in requests:
+				fh.write( json.dumps( entry ) + '\n' )
+			fh.write( json.dumps( { 'plugin': plugin, 'summary': recorder.summary() } ) + '\n' )
+	except OSError:
+		pass
+
+# plugins printing their output themselves get their trace at exit
+atexit.register( write_trace )
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -1,17 +1,124 @@
-"""generic API request functions."""
+"""generic API request functions.
 
-import requests
+'requests' is imported on the first request: importing it takes longer
+than many checks need for everything else, and some modes never send a
+request at all (e.g. when the answer is cached).
+"""
+
+import time
 import logging
+from urllib.parse import urlsplit
 from lib.generic_plugin import output_and_exit
+from lib import instrument, deadline
+
+# (connect, read) timeout in seconds
+HTTP_TIMEOUT     = (5, 30)
+# retry budget for idempotent requests: number of retries and the
+# backoff between them (factor and upper bound in seconds)
+HTTP_RETRIES     = 3
+HTTP_BACKOFF     = 0.5
+HTTP_BACKOFF_MAX = 10
+# connections kept open per host
+HTTP_POOLSIZE    = 4
+
+# one session (and thereby one keep-alive connection pool) per host
+_sessions = {}
+
+def _retry_policy():
+	from urllib3.util.retry import Retry
+
+	class DeadlineRetry( Retry ):
+		# no retry that would end after the deadline of the check
+		def is_exhausted( self ):
+			left = deadline.remaining()
+			if left is not None and left <= self.get_backoff_time():
+				return True
+			return super().is_exhausted()
+
+	policy = {
+		'total': HTTP_RETRIES,
+		'backoff_factor': HTTP_BACKOFF,
+		'status_forcelist': ( 429, 502, 503, 504 ),
+		'allowed_methods': ( 'GET', 'HEAD' ),
+		'respect_retry_after_header': True,
+		'raise_on_status': False,
+		}
+	try:
+		return DeadlineRetry( backoff_max=HTTP_BACKOFF_MAX, **policy )
+	except TypeError:
+		# urllib3 < 2.0 has no 'backoff_max' argument
+		return DeadlineRetry( **policy )
+
+def get_session( url ):
+	"""return the pooled session for the host of 'url'"""
+	parts = urlsplit( url )
+	key = ( parts.scheme, parts.netloc )
+
+	if key not in _sessions:
+		import requests
+		from requests.adapters import HTTPAdapter
+		requests.urllib3.disable_warnings()
+		session = requests.Session()
+		adapter = HTTPAdapter( pool_connections=1, pool_maxsize=HTTP_POOLSIZE,
+						max_retries=_retry_policy() )
+		session.mount( 'https://', adapter )
+		session.mount( 'http://', adapter )
+		_sessions[key] = session
 
-requests.urllib3.disable_warnings()
+	return _sessions[key]
+
+def http_request( url, method='get', timeout=None, gzip=True, **kwargs ):
+	"""send a request over the pooled session of the host
+
+	Keyword arguments are passed on to requests. GET and HEAD requests are
+	retried on connection errors and 429/502/503/504 answers, honoring a
+	'Retry-After' header. Set 'gzip' to False to request uncompressed
+	answers. The timeout is cut to the time left until the deadline of
+	the check (lib/deadline); DeadlineExceeded is raised when none is left.
+	"""
+	headers = dict( kwargs.pop( 'headers', None ) or {} )
+	if not gzip:
+		headers.setdefault( 'Accept-Encoding', 'identity' )
+	timeout = deadline.timeout( timeout or HTTP_TIMEOUT )
+
+	if not instrument.ENABLED:
+		return get_session( url ).request( method.upper(), url,
+			headers=headers, timeout=timeout, **kwargs )
+
+	start = time.monotonic()
+	try:
+		resp = get_session( url ).request( method.upper(), url,
+			headers=headers, timeout=timeout, **kwargs )
+	except Exception as e:
+		instrument.record( method, url, None, 0, time.monotonic() - start, error=repr(e) )
+		raise
+	_record( method, url, resp, time.monotonic() - start, kwargs.get( 'stream' ) )
+	return resp
+
+def _record( method, url, resp, seconds, stream ):
+	# streamed bodies are not read yet, only their announced size is known
+	if stream:
+		nbytes = int( resp.headers.get( 'Content-Length', 0 ) )
+	else:
+		nbytes = len( resp.content )
+	retries = getattr( resp.raw, 'retries', None )
+	instrument.record( method, url, resp.status_code, nbytes, seconds,
+		len( retries.history ) if retries else 0 )
 
 def request_json( url, header=None ):
+	"""GET 'url' and return the decoded JSON answer, exit UNKNOWN on errors
+
+	Uses the lightweight transport of lib/httpjson, so checks that only
+	call this never import requests.
+	"""
+	from lib.httpjson import get
 	result = None
 
 	try:
-		resp = requests.get( url, headers=header, verify=False )
+		resp = get( url, headers=header, verify=False )
 	except OSError as e:
+		if deadline.expired():
+			output_and_exit( 3, 'deadline reached, no answer from the device', repr(e), None )
 		output_and_exit( 3, 'Error occured while running the check' , repr(e), None)
 	except Exception as e:
 		output_and_exit( 3, 'Exception occured while running the check' , repr(e), None)
@@ -36,12 +143,10 @@ def apiRequest( url, method = 'get', verify=True, header=None, data=None ):
 	result = None
 	error  = None
 
-	if method == 'post':
-		resp = requests.post( url, verify=verify, headers=header, json=data )
-	elif method == 'delete':
-		resp = requests.delete( url, verify=verify, headers=header, json=data )
+	if method in ( 'post', 'delete' ):
+		resp = http_request( url, method, verify=verify, headers=header, json=data )
 	else:
-		resp = requests.get( url, verify=verify,  headers=header )
+		resp = http_request( url, verify=verify, headers=header )
 
 	if resp and (
 		'application/json' in resp.headers.get('Content-Type', '')
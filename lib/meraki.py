@@ -0,0 +1,278 @@
+"""Cisco Meraki dashboard: one organization-wide snapshot for all device checks.
+
+The device checks (network/meraki and the merakiAlerts, merakiPing, ...
+wrappers) do not query the dashboard per serial. The first check of a
+cycle collects a snapshot of all organizations of the API key with the
+organization-wide endpoints
+
+	/organizations/{id}/devices                        serial -> network, name, model
+	/organizations/{id}/devices/statuses               online, offline, alerting, dormant
+	/organizations/{id}/devices/uplinksLossAndLatency  loss and latency per uplink
+	/organizations/{id}/switch/ports/statuses/bySwitch port status, errors, warnings
+	/networks/{id}/health/alerts                       once per network with devices
+
+and stores it in the response cache (lib/cache); the other checks of the
+cycle wait for it and only look up their serial. The device inventory
+(the serial to network map) changes rarely and is kept for MAP_TTL.
+
+All requests of a process share a token bucket with the dashboard limit
+of MERAKI_RATE requests per second and organization; a 429 answer stops
+all of them for its 'Retry-After' seconds.
+"""
+
+import re
+import time
+import threading
+from urllib.parse import urljoin, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from lib import deadline
+from lib.cache import cached_json
+from lib.httpjson import get
+
+MERAKI_URL      = 'https://n121.dashboard.meraki.com'
+# dashboard API limit: requests per second and organization, and burst
+MERAKI_RATE     = 10
+MERAKI_BURST    = 10
+MERAKI_RETRIES  = 5
+# seconds a snapshot is shared by the checks
+SNAPSHOT_TTL    = 180
+# seconds the device inventory is kept; an unknown serial reloads an
+# inventory older than MAP_RECHECK
+MAP_TTL         = 3600
+MAP_RECHECK     = 300
+# seconds of uplink loss and latency averaged
+UPLINK_TIMESPAN = 300
+# requests in flight for the per-network endpoints
+WORKERS         = 4
+
+_NEXT = re.compile( r'<([^>]+)>;\s*rel="?next"?' )
+
+class MerakiError( Exception ):
+	"""the dashboard did not give a usable answer"""
+
+class TokenBucket:
+	"""'rate' requests per second with bursts of up to 'burst'; thread safe"""
+	def __init__( self, rate, burst ):
+		self.rate   = rate
+		self.burst  = burst
+		self.tokens = burst
+		self.stamp  = time.monotonic()
+		self.resume = 0     # no tokens before this time (after a 429)
+		self.lock   = threading.Lock()
+
+	def take( self ):
+		"""wait for a token"""
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				if now < self.resume:
+					wait, granted = self.resume - now, False
+				else:
+					self.tokens = min( self.burst, self.tokens + ( now - self.stamp ) * self.rate )
+					self.stamp = now
+					self.tokens -= 1
+					wait, granted = max( -self.tokens / self.rate, 0 ), True
+			if wait:
+				time.sleep( wait )
+			if granted:
+				return
+
+	def pause( self, seconds ):
+		"""no tokens for 'seconds', then start with an empty bucket"""
+		with self.lock:
+			self.resume = max( self.resume, time.monotonic() + seconds )
+			self.stamp  = self.resume
+			self.tokens = 0
+
+def _retry_after( resp ):
+	try:
+		return max( float( resp.headers.get( 'Retry-After' ) ), 0.1 )
+	except (TypeError, ValueError):
+		return 1.0
+
+def _error( resp ):
+	"""text of the 'errors' list of a dashboard answer"""
+	try:
+		return '; '.join( resp.json()['errors'] )
+	except (ValueError, KeyError, TypeError):
+		return resp.text[ :200 ]
+
+class Dashboard:
+	"""dashboard API client; all requests go through one token bucket"""
+	def __init__( self, url, apikey, rate=MERAKI_RATE, burst=MERAKI_BURST ):
+		url = ( url or MERAKI_URL ).rstrip( '/' )
+		self.url     = url if url.endswith( '/api/v1' ) else url + '/api/v1'
+		self.headers = { 'X-Cisco-Meraki-API-Key': apikey, 'Accept': 'application/json' }
+		self.bucket  = TokenBucket( rate, burst )
+		self.lock    = threading.Lock()
+		self.stats   = { 'requests': 0, 'throttled': 0 }
+
+	def _count( self, key ):
+		with self.lock:
+			self.stats[key] += 1
+
+	def request( self, url ):
+		"""GET 'url' (absolute or below /api/v1) and return the Response"""
+		if not url.startswith( ( 'http://', 'https://' ) ):
+			url = self.url + url
+		for attempt in range( MERAKI_RETRIES + 1 ):
+			self.bucket.take()
+			resp = get( url, headers=self.headers, retries=0 )
+			self._count( 'requests' )
+			if resp.status_code in ( 301, 302, 307, 308 ) and resp.headers.get( 'Location' ):
+				# api.meraki.com redirects to the shard of the organization
+				url = urljoin( url, resp.headers['Location'] )
+				continue
+			if resp.status_code != 429:
+				return resp
+			self._count( 'throttled' )
+			wait = _retry_after( resp )
+			left = deadline.remaining()
+			if left is not None and wait >= left:
+				break
+			self.bucket.pause( wait )
+		raise MerakiError( '{}: rate limited by the dashboard'.format( url ) )
+
+	def get_json( self, path, **params ):
+		if params:
+			path += '?' + urlencode( params )
+		resp = self.request( path )
+		if not resp:
+			raise MerakiError( '{}: {} {}'.format( path, resp.status_code, _error( resp ) ) )
+		return resp.json()
+
+	def get_all( self, path, **params ):
+		"""all items of a paged endpoint (Link: <...>; rel=next)"""
+		url = path + ( '?' + urlencode( params ) if params else '' )
+		items = []
+		while url:
+			resp = self.request( url )
+			if not resp:
+				raise MerakiError( '{}: {} {}'.format( path, resp.status_code, _error( resp ) ) )
+			answer = resp.json()
+			items += answer['items'] if isinstance( answer, dict ) else answer
+			link = _NEXT.search( resp.headers.get( 'Link', '' ) )
+			url = link.group(1) if link else None
+		return items
+
+#-----------------------------------------------------------------------
+# Collection
+#-----------------------------------------------------------------------
+
+def inventory( client ):
+	"""organizations and { serial: device } of all organizations of the key"""
+	orgs = [ { 'id': o['id'], 'name': o.get( 'name' ) } for o in client.get_json( '/organizations' ) ]
+	devices = {}
+	for org in orgs:
+		for device in client.get_all( '/organizations/{}/devices'.format( org['id'] ), perPage=1000 ):
+			device['organizationId'] = org['id']
+			devices[ device['serial'] ] = device
+	return { 'time': time.time(), 'organizations': orgs, 'devices': devices }
+
+def _mean( values ):
+	values = [ v for v in values if v is not None ]
+	return round( sum( values ) / len( values ), 2 ) if values else None
+
+def _statuses( client, org ):
+	return { s['serial']: { key: s.get( key ) for key in ( 'status', 'lastReportedAt', 'publicIp', 'lanIp' ) }
+		for s in client.get_all( '/organizations/{}/devices/statuses'.format( org ), perPage=1000 ) }
+
+def _uplinks( client, org ):
+	uplinks = {}
+	for u in client.get_json( '/organizations/{}/devices/uplinksLossAndLatency'.format( org ),
+			timespan=UPLINK_TIMESPAN ):
+		series = u.get( 'timeSeries' ) or []
+		uplinks.setdefault( u['serial'], [] ).append( { 'uplink': u.get( 'uplink' ), 'ip': u.get( 'ip' ),
+			'loss': _mean( t.get( 'lossPercent' ) for t in series ),
+			'latency': _mean( t.get( 'latencyMs' ) for t in series ) } )
+	return uplinks
+
+def _ports( client, org ):
+	return { switch['serial']: [ { key: p.get( key ) for key in ( 'portId', 'status', 'errors', 'warnings' ) }
+			for p in switch.get( 'ports' ) or [] ]
+		for switch in client.get_all( '/organizations/{}/switch/ports/statuses/bySwitch'.format( org ),
+			perPage=20 ) }
+
+def _alerts( client, network ):
+	return [ { 'category': a.get( 'category' ), 'type': a.get( 'type' ), 'severity': a.get( 'severity' ),
+		'devices': [ { 'serial': d.get( 'serial' ), 'url': d.get( 'url' ) }
+			for d in ( a.get( 'scope' ) or {} ).get( 'devices' ) or [] ] }
+		for a in client.get_json( '/networks/{}/health/alerts'.format( network ) ) ]
+
+def collect( client, inv ):
+	"""snapshot of the organizations and networks of inventory 'inv'
+
+	An endpoint that fails does not fail the snapshot; its error is kept
+	in 'errors' and the checks needing it report UNKNOWN.
+	"""
+	start = time.monotonic()
+	snap = { 'statuses': {}, 'uplinks': {}, 'ports': {}, 'alerts': {}, 'errors': [] }
+
+	def part( key, label, fetch, *args ):
+		try:
+			snap[key].update( fetch( client, *args ) )
+		except (OSError, MerakiError, ValueError, KeyError) as e:
+			snap['errors'].append( '{}: {}'.format( label, e ) )
+
+	for org in inv['organizations']:
+		label = "organization '{}'".format( org['name'] or org['id'] )
+		part( 'statuses', label + ' device statuses', _statuses, org['id'] )
+		part( 'uplinks', label + ' uplinks', _uplinks, org['id'] )
+		part( 'ports', label + ' switch ports', _ports, org['id'] )
+
+	networks = sorted( { d['networkId'] for d in inv['devices'].values() if d.get( 'networkId' ) } )
+	def alerts( network ):
+		if deadline.expired():
+			return network, None, 'deadline reached'
+		try:
+			return network, _alerts( client, network ), None
+		except (OSError, MerakiError, ValueError) as e:
+			return network, None, str(e)
+	with ThreadPoolExecutor( max_workers=WORKERS ) as pool:
+		for network, found, error in pool.map( deadline.bind( alerts ), networks ):
+			if error:
+				snap['errors'].append( 'alerts of network {}: {}'.format( network, error ) )
+			else:
+				snap['alerts'][network] = found
+
+	snap.update( client.stats, seconds=round( time.monotonic() - start, 3 ) )
+	return snap
+
+def snapshot( url, apikey, ttl=SNAPSHOT_TTL, cachedir=None, serial=None, rate=MERAKI_RATE ):
+	"""snapshot of all organizations of 'apikey', collected at most every 'ttl' seconds
+
+	{ 'time', 'organizations', 'devices': { serial: device }, 'statuses',
+	'uplinks', 'ports': { serial: ... }, 'alerts': { networkId: [...] },
+	'errors', 'requests', 'throttled', 'seconds' }. If 'serial' is not in
+	the inventory, an inventory older than MAP_RECHECK is reloaded.
+	"""
+	client = Dashboard( url, apikey, rate )
+	wait = deadline.remaining()
+
+	def fetch( map_ttl ):
+		inv = cached_json( client.url + '/check-inventory', apikey,
+			lambda: inventory( client ), map_ttl, cachedir )
+		snap = collect( client, inv )
+		# 'time' is taken after the collection, see below
+		snap.update( time=time.time(), inventory=inv['time'],
+			organizations=inv['organizations'], devices=inv['devices'] )
+		return snap
+
+	snap = cached_json( client.url + '/check-snapshot', apikey, lambda: fetch( MAP_TTL ),
+		ttl, cachedir, wait )
+	if serial and serial not in snap['devices'] and time.time() - snap['inventory'] > MAP_RECHECK:
+		# a new device: any snapshot written after the one we have will do
+		# (its file is at most a moment younger than its 'time')
+		snap = cached_json( client.url + '/check-snapshot', apikey, lambda: fetch( MAP_RECHECK ),
+			max( time.time() - snap['time'] - 1, 0 ), cachedir, deadline.remaining() )
+	return snap
+
+def device_alerts( snap, serial ):
+	"""alerts of the network of 'serial' that name the device; None if not collected"""
+	network = snap['devices'].get( serial, {} ).get( 'networkId' )
+	if network not in snap['alerts']:
+		return None
+	return [ a for a in snap['alerts'][network]
+		if any( d['serial'] == serial for d in a['devices'] ) ]
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,173 @@
+"""metrics sink: typed samples of many objects, spooled beside the perfdata.
+
+Checks of large arrays have one value per volume, aggregate or LUN;
+thousands of perfdata labels in one plugin output are more than Icinga
+and its perfdata writers handle well. Such plugins add the values of
+their objects as samples with a name, labels, unit and thresholds:
+
+	sink = MetricsSink( args.metrics_spool, 'ontap', { 'host': host } )
+	result = CheckResult( sink=sink, perf_max=args.perfdata_max )
+	for vol in vols:
+		result.metric( name, used, '%', warn, crit, name='volume_used', labels={ 'volume': name } )
+	result.perf( 'volumes', len(vols) )     # summary, always in the perfdata
+	sink.flush()
+
+flush() appends all samples of the check in one write to the spool file
+<spooldir>/<prefix>.prom (OpenMetrics text) or <prefix>.lp (InfluxDB line
+protocol), for a shipper like telegraf or vector to tail. In the .prom
+file every flush is an exposition of its own, ending with '# EOF'; a
+shipper reading the whole file has to split it there. A spool file
+growing over METRICS_ROTATE bytes is renamed to <file>.1 (.1 to .2, ...,
+METRICS_KEEP rotated files are kept). The perfdata of the check is cut to the
+perf_max objects with the highest values, those over their thresholds
+first (lib/generic_plugin, CheckResult).
+"""
+
+import os
+import re
+import time
+import fcntl
+
+METRICS_DIR    = '/var/spool/icinga2/metrics'
+METRICS_FORMAT = 'openmetrics'
+METRICS_ROTATE = 64 * 1024**2
+METRICS_KEEP   = 3
+# per-object perfdata of a check writing to a sink (CheckResult perf_max)
+PERFDATA_MAX   = 20
+
+FORMATS = { 'openmetrics': '.prom', 'influx': '.lp' }
+
+# perfdata units as OpenMetrics name suffixes; 'c' is a counter
+UNITS = { '%': 'percent', 's': 'seconds', 'ms': 'milliseconds', 'us': 'microseconds',
+	'B': 'bytes', 'KB': 'kilobytes', 'MB': 'megabytes', 'GB': 'gigabytes', 'TB': 'terabytes' }
+
+_NAME = re.compile( r'[^a-zA-Z0-9_]' )
+
+def metric_name( *parts ):
+	"""OpenMetrics name from 'parts': invalid characters become '_'"""
+	name = _NAME.sub( '_', '_'.join( p for p in parts if p ) )
+	return '_' + name if name[ :1 ].isdigit() else name
+
+def _number( value ):
+	return repr( value ) if isinstance( value, float ) else str( value )
+
+def _om_labels( labels ):
+	escape = lambda v: str( v ).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+	return '{' + ','.join( '{}="{}"'.format( metric_name( k ), escape( v ) )
+		for k, v in labels.items() ) + '}' if labels else ''
+
+def openmetrics_lines( prefix, labels, samples, ts ):
+	"""OpenMetrics exposition of 'samples', ending with '# EOF'
+
+	The samples are grouped by family, each with its TYPE and UNIT lines.
+	Thresholds are gauge families of their own, <name>_warning_<unit> and
+	<name>_critical_<unit>.
+	"""
+	families = {}   # name: (type, unit, sample lines), in order of appearance
+	stamp = ' {:.3f}'.format( ts )
+	for name, value, uom, extra, warn, crit, min, max in samples:
+		series = _om_labels( dict( labels, **extra ) if extra else labels )
+		counter = uom == 'c'
+		for suffix, number in ( ( None, value ), ( 'warning', warn ), ( 'critical', crit ) ):
+			if number is None:
+				continue
+			family = metric_name( prefix, name, suffix, UNITS.get( uom ) )
+			kind = 'counter' if counter and not suffix else 'gauge'
+			lines = families.setdefault( family, ( kind, UNITS.get( uom ), [] ) )[2]
+			lines.append( '{}{}{} {}{}\n'.format( family, '_total' if kind == 'counter' else '', series,
+				_number( number ), stamp ) )
+
+	lines = []
+	for family, ( kind, unit, samples ) in families.items():
+		lines.append( '# TYPE {} {}\n'.format( family, kind ) )
+		if unit:
+			lines.append( '# UNIT {} {}\n'.format( family, unit ) )
+		lines += samples
+	lines.append( '# EOF\n' )
+	return lines
+
+def _lp_escape( value, chars=',= ' ):
+	value = str( value )
+	for c in chars:
+		value = value.replace( c, '\\' + c )
+	return value
+
+def influx_lines( prefix, labels, samples, ts ):
+	"""InfluxDB line protocol of 'samples': the unit is a tag, thresholds are fields"""
+	lines = []
+	stamp = ' {}'.format( int( ts * 1e9 ) )
+	for name, value, uom, extra, warn, crit, min, max in samples:
+		tags = dict( labels, **extra ) if extra else dict( labels )
+		if uom:
+			tags['unit'] = uom
+		fields = [ ( 'value', value ), ( 'warn', warn ), ( 'crit', crit ), ( 'min', min ), ( 'max', max ) ]
+		lines.append( '{}{} {}{}\n'.format( _lp_escape( metric_name( prefix, name ), ', ' ),
+			''.join( ',{}={}'.format( _lp_escape( k ), _lp_escape( v ) ) for k, v in sorted( tags.items() ) ),
+			','.join( '{}={}'.format( k, '{}i'.format( v ) if uom == 'c' and isinstance( v, int ) else _number( v ) )
+				for k, v in fields if v is not None ),
+			stamp ) )
+	return lines
+
+def append_spool( path, data, rotate=METRICS_ROTATE, keep=METRICS_KEEP ):
+	"""append 'data' to 'path' in one locked write; rotate the file when it is full"""
+	while True:
+		fh = open( path, 'a' )
+		fcntl.flock( fh, fcntl.LOCK_EX )
+		# another check may have rotated the file while we waited
+		try:
+			if os.fstat( fh.fileno() ).st_ino == os.stat( path ).st_ino:
+				break
+		except FileNotFoundError:
+			pass
+		fh.close()
+	with fh:
+		size = os.fstat( fh.fileno() ).st_size
+		if rotate and size and size + len( data ) > rotate:
+			for n in range( keep - 1, 0, -1 ):
+				if os.path.exists( '{}.{}'.format( path, n ) ):
+					os.replace( '{}.{}'.format( path, n ), '{}.{}'.format( path, n + 1 ) )
+			os.replace( path, path + '.1' )
+			with open( path, 'a' ) as new:
+				new.write( data )
+		else:
+			fh.write( data )
+
+class MetricsSink:
+	"""samples of one check, written to the spool by flush()
+
+	'prefix' starts every metric name (usually the plugin), 'labels' are
+	added to every sample (e.g. the host). With 'spooldir' None the
+	samples are only collected.
+	"""
+	def __init__( self, spooldir, prefix, labels=None, fmt=METRICS_FORMAT ):
+		if fmt not in FORMATS:
+			raise ValueError( 'unknown metrics format {!r}'.format( fmt ) )
+		self.spooldir = spooldir
+		self.prefix   = prefix
+		self.labels   = dict( labels or {} )
+		self.fmt      = fmt
+		self.samples  = []      # (name, value, uom, labels, warn, crit, min, max)
+
+	def add( self, name, value, uom='', labels=None, warn=None, crit=None, min=None, max=None ):
+		if value is not None:
+			self.samples.append( ( name, value, uom, labels, warn, crit, min, max ) )
+
+	@property
+	def path( self ):
+		return os.path.join( self.spooldir, metric_name( self.prefix ) + FORMATS[self.fmt] )
+
+	def flush( self ):
+		"""append the samples to the spool file; returns their number
+
+		Raises OSError if the spool is not writable.
+		"""
+		if not self.spooldir or not self.samples:
+			return 0
+		render = openmetrics_lines if self.fmt == 'openmetrics' else influx_lines
+		data = ''.join( render( self.prefix, self.labels, self.samples, time.time() ) )
+		os.makedirs( self.spooldir, exist_ok=True )
+		append_spool( self.path, data )
+		count, self.samples = len( self.samples ), []
+		return count
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,446 @@
+"""spooled notifications: queueing, digests per host and contact, delivery.
+
+The notification commands only put an event into the spool (one JSON
+file per event, written atomically into <spooldir>/new) and return. A
+dispatcher drains the spool:
+
+	- events are grouped by channel, contact and host; a group is sent
+	  once its oldest event has waited 'window' seconds, so a switch going
+	  down with 200 services gives one message per contact, not 200
+	- within a group only the last event per service is shown, with the
+	  number of changes before it
+	- Telegram: one HTTP session for all messages, at most one message per
+	  second and chat and TELEGRAM_RATE messages per second overall; 429
+	  answers are retried after 'Retry-After' (parameters.retry_after);
+	  a chat told to wait longer than TELEGRAM_MAXWAIT gets no messages until
+	  then, its groups stay in the spool as waiting
+	- mail: one SMTP connection for all messages of a run
+	- events that could not be delivered stay in the spool for the next
+	  run and are dropped after 'maxage' seconds
+
+Only one dispatcher works on a spool at a time (<spooldir>/dispatch.lock).
+"""
+
+import os
+import json
+import time
+import html
+import logging
+from lib.cache import write_atomic, lock_file
+
+SPOOL_DIR        = '/var/spool/icinga2/notify'
+# seconds events of one host and contact are collected into one message
+NOTIFY_WINDOW    = 30
+# undeliverable events are dropped after this many seconds
+NOTIFY_MAXAGE    = 24 * 60**2
+# service output longer than this is cut
+OUTPUT_MAXLEN    = 3000
+
+TELEGRAM_URL      = 'https://api.telegram.org'
+TELEGRAM_MAXLEN   = 4096
+# messages per second: per chat and overall (Telegram bot API limits)
+TELEGRAM_INTERVAL = 1.0
+TELEGRAM_RATE     = 30
+TELEGRAM_RETRIES  = 5
+# longer waits demanded by 'Retry-After' leave the events for the next run
+TELEGRAM_MAXWAIT  = 60
+
+STATE_SYMBOL = { 'OK': '👍', 'WARNING': '⚠', 'CRITICAL': '🔥', 'UP': '⇑', 'DOWN': '⇓' }
+TYPE_SYMBOL  = { 'RECOVERY': '✅', 'PROBLEM': '❌', 'ACKNOWLEDGEMENT': '✓',
+				'DOWNTIMESTART': '🔕', 'DOWNTIMEEND': '🔔' }
+MAIL_EMOTICON = { 'RECOVERY': ':-)', 'PROBLEM': ':-(', 'ACKNOWLEDGEMENT': ':-|' }
+
+class NotifyError( Exception ):
+	"""a message could not be delivered (now)"""
+
+#-----------------------------------------------------------------------
+# Spool
+#-----------------------------------------------------------------------
+
+def enqueue( event, spooldir=None ):
+	"""put 'event' (dict) into the spool; returns the path of the event file"""
+	new = os.path.join( spooldir or SPOOL_DIR, 'new' )
+	os.makedirs( new, mode=0o700, exist_ok=True )
+	event = dict( event, queued=time.time() )
+	path = os.path.join( new, '{}-{}.json'.format( time.time_ns(), os.getpid() ) )
+	write_atomic( path, json.dumps( event ) )
+	return path
+
+def read_spool( spooldir ):
+	"""[ (path, event) ] of all queued events, oldest first"""
+	new = os.path.join( spooldir, 'new' )
+	events = []
+	try:
+		names = sorted( n for n in os.listdir( new ) if n.endswith( '.json' ) )
+	except FileNotFoundError:
+		return events
+	for name in names:
+		path = os.path.join( new, name )
+		try:
+			with open( path ) as fh:
+				events.append( ( path, json.load( fh ) ) )
+		except (OSError, ValueError):
+			logging.warning( 'unreadable event %s, removed', path )
+			_remove( [ path ] )
+	return events
+
+def _remove( paths ):
+	for path in paths:
+		try:
+			os.unlink( path )
+		except FileNotFoundError:
+			pass
+
+#-----------------------------------------------------------------------
+# Grouping
+#-----------------------------------------------------------------------
+
+def group_key( event ):
+	"""events with the same key end up in one message"""
+	return ( event.get( 'channel' ), event.get( 'recipient' ), event.get( 'sender' ) or '',
+		event.get( 'host' ) )
+
+def due_groups( events, window, now=None ):
+	"""[ [ (path, event), ... ] ] of the groups whose oldest event waited 'window' seconds"""
+	now = now or time.time()
+	groups = {}
+	for item in events:
+		groups.setdefault( group_key( item[1] ), [] ).append( item )
+	return [ items for items in groups.values()
+		if now - min( e['queued'] for _, e in items ) >= window ]
+
+def coalesce( events ):
+	"""last event per object (host or service) in order, with the number of changes before it"""
+	last = {}
+	for event in events:
+		key = event.get( 'service' ) or ''
+		count = last[key][1] + 1 if key in last else 0
+		# re-insert to keep the order of the latest events
+		last.pop( key, None )
+		last[key] = ( event, count )
+	return list( last.values() )
+
+#-----------------------------------------------------------------------
+# Message formats
+#-----------------------------------------------------------------------
+
+def _cut( text, limit ):
+	text = text or ''
+	return text if len( text ) <= limit else text[ :limit ] + ' [...]'
+
+def _icingaweb_link( event ):
+	if event.get( 'service' ):
+		return 'icingadb/service?name={}&host.name={}'.format( _quote( event['service'] ), _quote( event['host'] ) )
+	return 'icingadb/host?name={}'.format( _quote( event['host'] ) )
+
+def _quote( text ):
+	from urllib.parse import quote
+	return quote( text or '', safe='' )
+
+def telegram_message( group ):
+	"""HTML text for the events of one group (coalesced)"""
+	first = group[0][0]
+	e = lambda text: html.escape( str( text or '' ), quote=False )
+	ip = ''.join( ' [{}]'.format( e( first[k] ) ) for k in ( 'address', 'address6' ) if first.get( k ) )
+
+	if len( group ) == 1 and not group[0][1]:
+		event = first
+		if event.get( 'service' ):
+			subject = "{} [{}] '{}' on '{}' is {}!".format( TYPE_SYMBOL.get( event['type'], '' ), e( event['type'] ),
+				e( event.get( 'service_display' ) or event['service'] ), e( event['host_display'] ), e( event['state'] ) )
+		else:
+			subject = "{} [{}] Host '{}' is {}!".format( TYPE_SYMBOL.get( event['type'], '' ), e( event['type'] ),
+				e( event['host_display'] ), e( event['state'] ) )
+		lines = [ _telegram_subject( event, subject ), '', '⌚ {}'.format( e( event.get( 'datetime' ) ) ) ]
+		if event.get( 'service' ):
+			lines.append( '💻 {}{}'.format( e( event['host_display'] ), ip ) )
+			lines.append( '🔩 {} is <strong>{}</strong> {}'.format( e( event.get( 'service_display' ) ),
+				e( event['state'] ), STATE_SYMBOL.get( event['state'], '' ) ) )
+		else:
+			lines.append( '💻 {}{} is <strong>{}</strong> {}'.format( e( event['host_display'] ), ip,
+				e( event['state'] ), STATE_SYMBOL.get( event['state'], '' ) ) )
+		lines += [ '', '<code>{}</code>'.format( e( _cut( event.get( 'output' ), OUTPUT_MAXLEN ) ) ) ]
+		if event.get( 'comment' ):
+			lines += [ '', '<b>Comment by {}:</b> <code>{}</code>'.format(
+				e( event.get( 'author' ) or 'ErrorUnknownAuthor' ), e( event['comment'] ) ) ]
+	else:
+		# digest: one line per object
+		subject = "📋 {} notifications for '{}'".format( sum( 1 + n for _, n in group ), e( first['host_display'] ) )
+		lines = [ _telegram_subject( dict( first, service=None ), subject ),
+			'', '💻 {}{}'.format( e( first['host_display'] ), ip ),
+			'⌚ {} – {}'.format( e( group[0][0].get( 'datetime' ) ), e( group[-1][0].get( 'datetime' ) ) ), '' ]
+		for event, changes in group:
+			lines.append( '{} {} <strong>{}</strong> {}{}\n<code>{}</code>'.format(
+				TYPE_SYMBOL.get( event['type'], e( event['type'] ) ),
+				e( event.get( 'service_display' ) or 'Host' ), e( event['state'] ),
+				STATE_SYMBOL.get( event['state'], '' ),
+				' ({} changes before)'.format( changes ) if changes else '',
+				e( _cut( ( event.get( 'output' ) or '' ).split( '\n' )[0], 200 ) ) ) )
+
+	text = '\n'.join( lines )
+	if len( text ) > TELEGRAM_MAXLEN:
+		text = text[ :TELEGRAM_MAXLEN - 80 ].rpartition( '\n' )[0] + \
+			'\n<b>WARNING: message was too long and has been truncated!</b>'
+	return text
+
+def _telegram_subject( event, subject ):
+	if event.get( 'icingaweb' ):
+		return "<a href='https://{}/icingaweb2/{}'>{}</a>".format(
+			html.escape( event['icingaweb'] ), html.escape( _icingaweb_link( event ) ), subject )
+	return '<u>{}</u>'.format( subject )
+
+HLINE = '-' * 67
+DLINE = '- ' * 33 + '-'
+
+def _center( text ):
+	return ' ' * max( len( HLINE ) // 2 - len( text ) // 2, 0 ) + text
+
+def mail_message( group, origin ):
+	"""(subject, body) for the events of one group (coalesced)"""
+	first = group[0][0]
+	customer = first.get( 'customer' )
+	host = first['host'] + ''.join( ' ({})'.format( first[k] ) for k in ( 'address', 'address6' ) if first.get( k ) )
+
+	if len( group ) == 1 and not group[0][1]:
+		event = first
+		if event.get( 'service' ):
+			subject = "[{} | {}] '{}' on '{}'".format( event['type'], event['state'],
+				event.get( 'service_display' ), event['host_display'] )
+		else:
+			subject = "[{} | {}] Host '{}'".format( event['type'], event['state'], event['host_display'] )
+		emo = MAIL_EMOTICON.get( event['type'], '' )
+		headline = [ _center( '-=   {} {} {}   =-'.format( emo, event['type'], emo ) ), '',
+			_center( 'STATUS is **{}**'.format( event['state'] ) ) ]
+	else:
+		count = {}
+		for event, changes in group:
+			count[ event['type'] ] = count.get( event['type'], 0 ) + 1
+		subject = "[{} notifications] '{}': {}".format( len( group ), first['host_display'],
+			', '.join( '{} {}'.format( n, t ) for t, n in count.items() ) )
+		headline = [ _center( '-=   {} notifications   =-'.format( len( group ) ) ) ]
+	if customer:
+		subject += ' ({})'.format( customer )
+
+	body = [ HLINE, '', _center( 'MR Datentechnik Monitoring System' ), '', HLINE ]
+	if customer:
+		body += [ _center( "KUNDE: '{}'".format( customer ) ), DLINE ]
+	body += [ '' ] + headline + [ '', 'HostObject: {}'.format( host ),
+		'Hostname:   {}'.format( first['host_display'] ) ]
+
+	for event, changes in group:
+		if len( group ) > 1 or changes:
+			body += [ '', DLINE, '[{} | {}]{}'.format( event['type'], event['state'],
+				'  ({} changes before)'.format( changes ) if changes else '' ) ]
+		if event.get( 'service' ):
+			body += [ '', 'Service:    {} ({})'.format( event.get( 'service_display' ), event['service'] ) ]
+		body += [ '', '', 'Message-Details:', '----------------', _cut( event.get( 'output' ), OUTPUT_MAXLEN ) ]
+		if event.get( 'comment' ):
+			body += [ '', 'Comment by {}:'.format( event.get( 'author' ) ), '  ' + event['comment'] ]
+		if event.get( 'icingaweb' ):
+			body += [ '', '', 'Link to IcingaWeb:', '------------------',
+				'{}/{}'.format( event['icingaweb'].rstrip( '/' ), _icingaweb_link( event ) ) ]
+
+	body += [ '', '', _center( 'Technical Details' ), DLINE,
+		'This Notification was sent from {}'.format( origin ),
+		'at {}'.format( group[-1][0].get( 'datetime' ) ), '' ]
+	# parsable lines for ticket automation
+	for event, changes in group:
+		if event.get( 'service' ):
+			body.append( '[Type:"service";Host:"{}";Service:"{}"]'.format( event['host'], event['service'] ) )
+		else:
+			body.append( '[Type:"host";Host:"{}"]'.format( event['host'] ) )
+	body += [ DLINE, '' ]
+	return subject, '\n'.join( body )
+
+#-----------------------------------------------------------------------
+# Delivery
+#-----------------------------------------------------------------------
+
+class TelegramSender:
+	"""Telegram bot API client keeping to the rate limits"""
+	def __init__( self, url=None, interval=TELEGRAM_INTERVAL, rate=TELEGRAM_RATE ):
+		self.url      = ( url or TELEGRAM_URL ).rstrip( '/' )
+		self.interval = interval
+		self.spacing  = 1 / rate if rate else 0
+		self.last     = {}      # chat: time.monotonic() of its last message
+		self.next     = 0       # earliest time for the next message of any chat
+		self.blocked  = {}      # chat: time.monotonic() its long 'Retry-After' ends
+		self.stats    = { 'sent': 0, 'throttled': 0 }
+
+	def _wait( self, chat ):
+		now = time.monotonic()
+		ready = max( self.next, self.last.get( chat, 0 ) + self.interval )
+		if ready > now:
+			time.sleep( ready - now )
+
+	def held( self, chat ):
+		"""seconds 'chat' still has to wait after a long 'Retry-After', 0 if none"""
+		left = self.blocked.get( chat, 0 ) - time.monotonic()
+		if left <= 0:
+			self.blocked.pop( chat, None )
+			return 0
+		return left
+
+	def send( self, token, chat, text ):
+		from lib.jsonapi import http_request
+		left = self.held( chat )
+		if left:
+			raise NotifyError( 'Telegram: rate limited for {:.0f}s more'.format( left ) )
+		url = '{}/bot{}/sendMessage'.format( self.url, token )
+		data = { 'chat_id': chat, 'text': text, 'parse_mode': 'HTML',
+			'disable_web_page_preview': 'true' }
+		for attempt in range( TELEGRAM_RETRIES ):
+			self._wait( chat )
+			try:
+				resp = http_request( url, 'post', data=data )
+			except OSError as e:
+				raise NotifyError( 'Telegram: {}'.format( repr(e) ) )
+			now = time.monotonic()
+			self.last[chat] = now
+			self.next = now + self.spacing
+
+			if resp.status_code == 429:
+				wait = _retry_after( resp )
+				self.stats['throttled'] += 1
+				if wait > TELEGRAM_MAXWAIT:
+					self.blocked[chat] = now + wait
+					raise NotifyError( 'Telegram: rate limited for {}s'.format( wait ) )
+				# the limit counts for this chat and, if global, for all others
+				self.last[chat] = now + wait - self.interval
+				self.next = now + wait
+				continue
+			if not resp:
+				raise NotifyError( 'Telegram: {} {}'.format( resp.status_code, resp.text[ :200 ] ) )
+			self.stats['sent'] += 1
+			return
+		raise NotifyError( 'Telegram: still rate limited after {} attempts'.format( TELEGRAM_RETRIES ) )
+
+	def close( self ):
+		pass
+
+def _retry_after( resp ):
+	"""seconds to wait from a 429 answer of the bot API"""
+	try:
+		return float( resp.json()['parameters']['retry_after'] )
+	except (ValueError, KeyError, TypeError):
+		pass
+	try:
+		return float( resp.headers.get( 'Retry-After' ) )
+	except (TypeError, ValueError):
+		return 1.0
+
+class MailSender:
+	"""SMTP client using one connection for all messages"""
+	def __init__( self, host='localhost', port=25, starttls=False, user=None, password=None,
+			sender=None, timeout=30 ):
+		self.host     = host
+		self.port     = port
+		self.starttls = starttls
+		self.user     = user
+		self.password = password
+		self.sender   = sender
+		self.timeout  = timeout
+		self.smtp     = None
+		self.stats    = { 'sent': 0, 'connections': 0 }
+
+	def _connect( self ):
+		import smtplib
+		smtp = smtplib.SMTP( self.host, self.port, timeout=self.timeout )
+		if self.starttls:
+			smtp.starttls()
+		if self.user:
+			smtp.login( self.user, self.password )
+		self.stats['connections'] += 1
+		self.smtp = smtp
+
+	def send( self, to, subject, body, sender=None ):
+		import smtplib
+		from email.message import EmailMessage
+		msg = EmailMessage()
+		msg['Subject'] = subject
+		msg['From']    = sender or self.sender or 'icinga@{}'.format( os.uname().nodename )
+		msg['To']      = to
+		msg.set_content( body )
+
+		for attempt in ( 1, 2 ):
+			try:
+				if self.smtp is None:
+					self._connect()
+				self.smtp.send_message( msg )
+				self.stats['sent'] += 1
+				return
+			except smtplib.SMTPServerDisconnected:
+				# the server closed an idle connection; reconnect once
+				self.smtp = None
+				if attempt == 2:
+					raise NotifyError( 'SMTP: server disconnected' )
+			except (smtplib.SMTPException, OSError) as e:
+				self.close()
+				raise NotifyError( 'SMTP: {}'.format( repr(e) ) )
+
+	def close( self ):
+		if self.smtp is not None:
+			try:
+				self.smtp.quit()
+			except Exception:
+				pass
+			self.smtp = None
+
+def deliver( group, senders, origin ):
+	"""send the message for one group of events"""
+	event = group[0][1]
+	events = coalesce( [ e for _, e in group ] )
+	channel = event.get( 'channel' )
+	if channel == 'telegram':
+		senders['telegram'].send( event['sender'], event['recipient'], telegram_message( events ) )
+	elif channel == 'mail':
+		subject, body = mail_message( events, origin )
+		senders['mail'].send( event['recipient'], subject, body, event.get( 'sender' ) )
+	else:
+		raise NotifyError( 'unknown channel {}'.format( channel ) )
+
+def dispatch( spooldir, senders, window=NOTIFY_WINDOW, maxage=NOTIFY_MAXAGE, origin=None ):
+	"""send all due groups once; returns counts or None if another dispatcher runs
+
+	'senders' maps the channels to TelegramSender and MailSender objects;
+	their connections stay open for the next call, close() them at the end.
+	"""
+	spooldir = spooldir or SPOOL_DIR
+	os.makedirs( spooldir, mode=0o700, exist_ok=True )
+	lock = lock_file( os.path.join( spooldir, 'dispatch.lock' ), 0 )
+	if lock is None:
+		return None
+
+	summary = { 'events': 0, 'messages': 0, 'failed': 0, 'dropped': 0, 'waiting': 0 }
+	try:
+		now = time.time()
+		events = []
+		for path, event in read_spool( spooldir ):
+			if now - event.get( 'queued', now ) > maxage:
+				logging.warning( 'dropping event for %s after %ss', event.get( 'recipient' ), maxage )
+				_remove( [ path ] )
+				summary['dropped'] += 1
+			else:
+				events.append( ( path, event ) )
+
+		groups = due_groups( events, window, now )
+		summary['waiting'] = len( events ) - sum( len(g) for g in groups )
+		for group in groups:
+			event = group[0][1]
+			if event.get( 'channel' ) == 'telegram' and senders['telegram'].held( event['recipient'] ):
+				summary['waiting'] += len( group )
+				continue
+			try:
+				deliver( group, senders, origin or os.uname().nodename )
+			except NotifyError as e:
+				logging.error( 'delivery to %s failed, kept for the next run: %s', group[0][1].get( 'recipient' ), e )
+				summary['failed'] += 1
+				continue
+			_remove( [ path for path, _ in group ] )
+			summary['events'] += len( group )
+			summary['messages'] += 1
+		return summary
+	finally:
+		lock.close()
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,120 @@
+"""object state store: the last state of many objects per host, for change reports.
+
+Checks of devices with thousands of similar objects (VPN tunnels, managed
+access points and switches) only report what changed since their last run
+and what is not OK. The last state of every object is kept in one state
+file per host, kind and scope (the objects selected by a filter, so checks
+of the same host with different filters keep their own states), read in
+one pass:
+
+	header: b'OBJ1', number of state names, number of records  (struct '<4sII')
+	names:  length, UTF-8 state name                           (struct '<B' + bytes)
+	record: key hash, index of the state name, since           (struct '<QHd')
+
+'since' is the time the object was first seen in its state, 0 if it was
+already in it when the store was created.
+"""
+
+import os
+import time
+import struct
+from lib.cache import lock_file, write_atomic
+from lib.counters import key_hash
+
+OBJSTATE_DIR      = '/var/tmp/check-plugins/objstate'
+# how long to wait for another check updating the same host
+OBJSTATE_LOCKWAIT = 30
+
+_HEADER = struct.Struct( '<4sII' )
+_NAME   = struct.Struct( '<B' )
+_RECORD = struct.Struct( '<QHd' )
+_MAGIC  = b'OBJ1'
+
+def read_states( path ):
+	"""return {key hash: (state, since)} of a state file, None if there is none"""
+	try:
+		with open( path, 'rb' ) as fh:
+			data = fh.read()
+	except OSError:
+		return None
+	try:
+		magic, nnames, count = _HEADER.unpack_from( data )
+		if magic != _MAGIC:
+			return None
+		names, offset = [], _HEADER.size
+		for n in range( nnames ):
+			size, = _NAME.unpack_from( data, offset )
+			offset += _NAME.size
+			names.append( data[ offset:offset + size ].decode() )
+			offset += size
+		if len( data ) != offset + count * _RECORD.size:
+			return None
+		return { h: ( names[i], since ) for h, i, since in _RECORD.iter_unpack( data[ offset: ] ) }
+	except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+		return None
+
+def write_states( path, states ):
+	"""write {key hash: (state, since)} atomically"""
+	names = sorted( { state for state, since in states.values() } )
+	index = { name: i for i, name in enumerate( names ) }
+	encoded = [ name.encode()[ :255 ] for name in names ]
+	data = [ _HEADER.pack( _MAGIC, len( names ), len( states ) ) ]
+	data += [ _NAME.pack( len(e) ) + e for e in encoded ]
+	data += [ _RECORD.pack( h, index[state], since ) for h, ( state, since ) in sorted( states.items() ) ]
+	write_atomic( path, b''.join( data ), 'wb' )
+
+def state_path( statedir, host, kind, scope=None ):
+	"""state file of the 'kind' objects of 'host' selected by 'scope'"""
+	name = '{}.{}'.format( host.replace( '/', '_' ), kind )
+	if scope:
+		name += '.{:016x}'.format( key_hash( scope ) )
+	return os.path.join( statedir, name + '.objstate' )
+
+def object_changes( host, kind, current, statedir=None, scope=None ):
+	"""store the states {key: state} of the 'kind' objects of 'host', return the changes
+
+	'scope' describes the selection of the objects (e.g. an include
+	filter), every scope has a state of its own.
+
+	Returns a dict:
+		first:   True if there was no stored state (nothing is reported changed)
+		changed: {key: previous state} of the objects whose state changed,
+		         None for objects not seen before
+		since:   {key: time the object entered its state, 0 if unknown}
+		gone:    number of stored objects missing in 'current'
+	"""
+	statedir = statedir or OBJSTATE_DIR
+	path = state_path( statedir, host, kind, scope )
+
+	try:
+		os.makedirs( statedir, mode=0o700, exist_ok=True )
+		lock = lock_file( path + '.lock', OBJSTATE_LOCKWAIT )
+	except OSError:
+		lock = None
+
+	try:
+		stored = read_states( path )
+		first = stored is None
+		stored = stored or {}
+		now = time.time()
+		states, changed, since = {}, {}, {}
+		for key, state in current.items():
+			h = key_hash( key )
+			old = stored.pop( h, None )
+			if old is not None and old[0] == state:
+				states[h] = old
+			else:
+				states[h] = ( state, 0 if first else now )
+				if not first:
+					changed[key] = None if old is None else old[0]
+			since[key] = states[h][1]
+		try:
+			write_states( path, states )
+		except OSError:
+			pass
+		return { 'first': first, 'changed': changed, 'since': since, 'gone': len( stored ) }
+	finally:
+		if lock:
+			lock.close()
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,80 @@
+"""submit passive check results to Icinga.
+
+Results go either to a file (the Icinga command pipe or a spool file that
+is fed into it) as PROCESS_SERVICE_CHECK_RESULT external commands, or to
+the Icinga 2 REST API (action 'process-check-result') if the target is
+an http(s) URL.
+
+A result is a tuple (host, service, rc, output, perfdata): the plugin
+output without perfdata and the perfdata as a string, so '|' in the
+output (tables, ...) is not taken for the start of the perfdata.
+"""
+
+import time
+import fcntl
+import stat
+import os
+from lib.jsonapi import http_request
+
+def passive_command( host, service, rc, output, perfdata='' ):
+	"""external command line for one result"""
+	# Icinga takes the perfdata from the first '|' of the output: a '|' in the
+	# text becomes a broken bar. The command pipe reads one line per command;
+	# newlines are escaped.
+	output = output.rstrip( '\n' ).replace( '|', '\u00a6' )
+	if perfdata.strip():
+		output += '|' + perfdata.strip()
+	return '[{}] PROCESS_SERVICE_CHECK_RESULT;{};{};{};{}\n'.format(
+		int( time.time() ), host, service, rc, output.replace( '\n', '\\n' ) )
+
+def write_passive( path, results ):
+	"""append results [ (host, service, rc, output, perfdata), ... ] to a command pipe or spool file"""
+	lines = [ passive_command( *result ) for result in results ]
+	is_pipe = os.path.exists( path ) and stat.S_ISFIFO( os.stat( path ).st_mode )
+
+	with open( path, 'a', encoding='utf-8' ) as fh:
+		if is_pipe:
+			# one write per command: lines up to PIPE_BUF are not interleaved
+			for line in lines:
+				fh.write( line )
+				fh.flush()
+		else:
+			fcntl.flock( fh, fcntl.LOCK_EX )
+			fh.write( ''.join( lines ) )
+
+def api_passive( url, auth, results, source=None ):
+	"""send results to the Icinga 2 API at 'url' (e.g. https://icinga:5665)"""
+	errors = []
+	for host, service, rc, output, perfdata in results:
+		data = {
+			'type': 'Service',
+			'filter': 'host.name==hostname && service.name==servicename',
+			'filter_vars': { 'hostname': host, 'servicename': service },
+			'exit_status': rc,
+			'plugin_output': output.rstrip( '\n' ),
+			'performance_data': perfdata.split(),
+			}
+		if source:
+			data['check_source'] = source
+		try:
+			resp = http_request( url.rstrip('/') + '/v1/actions/process-check-result', 'post',
+				auth=auth, verify=False, json=data, headers={ 'Accept': 'application/json' } )
+		except OSError as e:
+			errors.append( '{}!{}: {}'.format( host, service, repr(e) ) )
+			continue
+		if not resp:
+			errors.append( '{}!{}: {} {}'.format( host, service, resp.status_code, resp.text ) )
+	return errors
+
+def submit_passive( target, results, auth=None, source=None ):
+	"""send results to 'target' (file path or Icinga API URL); returns a list of errors"""
+	if target.startswith( ( 'http://', 'https://' ) ):
+		return api_passive( target, auth, results, source )
+
+	try:
+		write_passive( target, results )
+	except OSError as e:
+		return [ 'writing {}: {}'.format( target, e ) ]
+	return []
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,193 @@
+"""run check-plugins inside a long running process instead of one interpreter per check.
+
+The runner listens on a UNIX socket. Each request names a plugin script
+and its command line; the script is compiled once and executed in a
+worker thread with its own sys.argv, stdout and stderr. Modules imported
+by the plugins (requests, tabulate2, lib.*) and the connection pools of
+lib.jsonapi stay loaded between checks.
+
+Threads started by a plugin (directly or by a ThreadPoolExecutor it
+creates) take over the argv, stdout, stderr, deadline and instrument
+recorder of the check that starts them. Pools shared between checks
+would keep those of the first one.
+
+Protocol: one JSON object per line.
+	request:  {"plugin": "<path>", "argv": [ ... ]}
+	answer:   {"rc": <int>, "stdout": "...", "stderr": "..."}
+"""
+
+import io
+import os
+import sys
+import json
+import socket
+import threading
+import socketserver
+from lib import instrument, deadline
+
+RUNNER_SOCKET  = '/run/icinga2/check-runner.sock'
+RUNNER_WORKERS = 16
+# base directory of the check-plugins; only scripts below it are served
+PLUGIN_ROOT    = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+
+_local = threading.local()
+
+class _ThreadStream:
+	"""file object writing into the buffer of the current check, if any"""
+	def __init__( self, name, default ):
+		self._name = name
+		self._default = default
+
+	def _target( self ):
+		return getattr( _local, self._name, None ) or self._default
+
+	def write( self, data ):
+		return self._target().write( data )
+
+	def flush( self ):
+		return self._target().flush()
+
+	def __getattr__( self, attr ):
+		return getattr( self._target(), attr )
+
+class _ThreadArgv( list ):
+	"""sys.argv replacement returning the command line of the current check"""
+	def _target( self ):
+		return getattr( _local, 'argv', None ) or list.copy( self )
+
+	def __getitem__( self, i ):  return self._target()[i]
+	def __len__( self ):         return len( self._target() )
+	def __iter__( self ):        return iter( self._target() )
+
+# per-check state of a thread, handed on to the threads it starts
+_CONTEXT = ( 'argv', 'stdout', 'stderr' )
+_thread_start = threading.Thread.start
+
+def _start( self ):
+	"""threading.Thread.start: the new thread belongs to the check of the current one"""
+	context = { name: getattr( _local, name, None ) for name in _CONTEXT }
+	if context['stdout'] is not None:
+		run = instrument.bind( deadline.bind( self.run ) )
+		def run_in_check():
+			_local.__dict__.update( context )
+			try:
+				run()
+			finally:
+				for name in _CONTEXT:
+					setattr( _local, name, None )
+		self.run = run_in_check
+	return _thread_start( self )
+
+_code_cache = {}
+_code_lock = threading.Lock()
+
+def _compiled( path ):
+	"""compile a plugin once; recompile when the file changed"""
+	mtime = os.stat( path ).st_mtime
+	with _code_lock:
+		cached = _code_cache.get( path )
+		if cached and cached[0] == mtime:
+			return cached[1]
+	with open( path, 'rb' ) as fh:
+		code = compile( fh.read(), path, 'exec' )
+	with _code_lock:
+		_code_cache[path] = ( mtime, code )
+	return code
+
+def run_plugin( path, argv ):
+	"""run a plugin in the current thread; returns (rc, stdout, stderr)"""
+	path = os.path.realpath( path )
+	if os.path.commonpath( [ path, PLUGIN_ROOT ] ) != PLUGIN_ROOT:
+		return ( 3, '(UNKNOWN) plugin outside of {}\n'.format( PLUGIN_ROOT ), '' )
+
+	_local.argv   = [ path ] + list( argv )
+	_local.stdout = io.StringIO()
+	_local.stderr = io.StringIO()
+	instrument.begin()
+	deadline.begin()
+	rc = 0
+	try:
+		exec( _compiled( path ), { '__name__': '__main__', '__file__': path } )
+	except SystemExit as e:
+		if e.code is None:
+			rc = 0
+		elif isinstance( e.code, int ):
+			rc = e.code
+		else:
+			print( e.code, file=sys.stderr )
+			rc = 3
+	except Exception as e:
+		print( '(UNKNOWN) Exception occured while running the check: {}'.format( repr(e) ) )
+		rc = 3
+	finally:
+		instrument.end()
+		deadline.end()
+		stdout = _local.stdout.getvalue()
+		stderr = _local.stderr.getvalue()
+		_local.argv = _local.stdout = _local.stderr = None
+		# plugins append their lib path on every run
+		with _code_lock:
+			sys.path[:] = list( dict.fromkeys( sys.path ) )
+
+	return ( rc, stdout, stderr )
+
+class _Handler( socketserver.StreamRequestHandler ):
+	def handle( self ):
+		with self.server.slots:
+			try:
+				request = json.loads( self.rfile.readline() )
+				rc, stdout, stderr = run_plugin( request['plugin'], request.get('argv', []) )
+			except (ValueError, KeyError, OSError) as e:
+				rc, stdout, stderr = 3, '(UNKNOWN) Invalid runner request: {}\n'.format( repr(e) ), ''
+			answer = { 'rc': rc, 'stdout': stdout, 'stderr': stderr }
+			self.wfile.write( json.dumps( answer ).encode() + b'\n' )
+
+class _Server( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ):
+	daemon_threads = True
+
+def install():
+	"""redirect sys.stdout, sys.stderr and sys.argv per thread for run_plugin()"""
+	if not isinstance( sys.stdout, _ThreadStream ):
+		sys.stdout = _ThreadStream( 'stdout', sys.stdout )
+		sys.stderr = _ThreadStream( 'stderr', sys.stderr )
+		sys.argv   = _ThreadArgv( sys.argv )
+		threading.Thread.start = _start
+	if PLUGIN_ROOT not in sys.path:
+		sys.path.append( PLUGIN_ROOT )
+
+def serve( socket_path=None, workers=None ):
+	"""serve check requests on 'socket_path' until interrupted"""
+	socket_path = socket_path or RUNNER_SOCKET
+	install()
+
+	if os.path.exists( socket_path ):
+		os.unlink( socket_path )
+	old_umask = os.umask( 0o117 )
+	try:
+		server = _Server( socket_path, _Handler )
+	finally:
+		os.umask( old_umask )
+	server.slots = threading.BoundedSemaphore( workers or RUNNER_WORKERS )
+
+	with server:
+		server.serve_forever()
+
+def run_remote( plugin, argv, socket_path=None, timeout=None ):
+	"""send a check request to the runner; returns (rc, stdout, stderr)
+
+	Raises OSError when the runner is not reachable.
+	"""
+	request = { 'plugin': os.path.abspath( plugin ), 'argv': list( argv ) }
+	with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as sock:
+		sock.settimeout( timeout )
+		sock.connect( socket_path or RUNNER_SOCKET )
+		sock.sendall( json.dumps( request ).encode() + b'\n' )
+		with sock.makefile( 'rb' ) as fh:
+			line = fh.readline()
+
+	if not line:
+		raise ConnectionError( 'runner closed the connection' )
+	answer = json.loads( line )
+	return ( answer['rc'], answer['stdout'], answer['stderr'] )
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
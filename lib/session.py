@@ -0,0 +1,114 @@
+"""login session cache for check-plugins: reuse tokens until shortly before they expire."""
+
+import os
+import json
+import time
+from lib.cache import fingerprint, lock_file, write_atomic
+from lib import instrument
+
+SESSION_DIR     = '/var/spool/icinga2/tmp'
+# renew tokens this many seconds before they expire
+SESSION_MARGIN  = 60
+# keep cached server facts (e.g. API versions) for this many seconds
+FACTS_TTL       = 24 * 60**2
+# how long to wait for another check logging in to the same device
+SESSION_LOCKWAIT = 30
+
+def _session_path( kind, host, credential, cachedir ):
+	name = '{}_{}_{}.session'.format( kind, host.replace( '/', '_' ),
+							fingerprint( credential )[:16] )
+	return os.path.join( cachedir or SESSION_DIR, name )
+
+def _read( path ):
+	try:
+		with open( path, 'r', encoding='utf-8' ) as fh:
+			return json.load( fh )
+	except (OSError, ValueError):
+		return {}
+
+def _valid( entry, margin ):
+	return entry.get('token') is not None and entry.get('expires', 0) - margin > time.time()
+
+def _update( path, change ):
+	"""apply 'change(entry)' to the session file while holding its lock
+
+	Without a usable cache directory, 'change' is applied to an empty entry.
+	"""
+	try:
+		os.makedirs( os.path.dirname( path ), mode=0o700, exist_ok=True )
+		lock = lock_file( path + '.lock', SESSION_LOCKWAIT )
+	except OSError:
+		return change( {} )
+
+	try:
+		entry = change( _read( path ) )
+		try:
+			write_atomic( path, json.dumps( entry ) )
+		except OSError:
+			pass
+		return entry
+	finally:
+		if lock:
+			lock.close()
+
+def cached_login( kind, host, credential, login, cachedir=None, margin=SESSION_MARGIN ):
+	"""return a session entry for 'host', calling 'login()' only when needed
+
+	'login' returns the new token (any JSON serializable value) and its
+	lifetime in seconds. The entry is a dict with 'token', 'expires' and
+	'facts'. Concurrent checks wait for the one that logs in and reuse its
+	token.
+	"""
+	path = _session_path( kind, host, credential, cachedir )
+
+	entry = _read( path )
+	if _valid( entry, margin ):
+		return entry
+
+	def renew( entry ):
+		# someone else might have logged in while we were waiting
+		if _valid( entry, margin ):
+			return entry
+		with instrument.phase( 'login' ):
+			token, lifetime = login()
+		entry.update( { 'token': token, 'expires': time.time() + lifetime } )
+		entry.setdefault( 'facts', {} )
+		return entry
+
+	return _update( path, renew )
+
+def drop_session( kind, host, credential, cachedir=None, token=None ):
+	"""forget the token, e.g. after the device rejected it; facts are kept
+
+	With 'token' the entry is only dropped while it still holds that token,
+	a newer one of another check is kept.
+	"""
+	path = _session_path( kind, host, credential, cachedir )
+
+	def forget( entry ):
+		if token is not None and entry.get( 'token' ) != token:
+			return entry
+		entry.pop( 'token', None )
+		entry['expires'] = 0
+		return entry
+
+	_update( path, forget )
+
+def cached_fact( kind, host, credential, name, fetch, cachedir=None, ttl=FACTS_TTL ):
+	"""return a cached server fact, calling 'fetch()' when unknown or outdated"""
+	path = _session_path( kind, host, credential, cachedir )
+
+	fact = _read( path ).get( 'facts', {} ).get( name )
+	if fact and time.time() - fact['time'] < ttl:
+		return fact['value']
+
+	value = fetch()
+
+	def store( entry ):
+		entry.setdefault( 'facts', {} )[name] = { 'value': value, 'time': time.time() }
+		return entry
+
+	_update( path, store )
+	return value
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -0,0 +1,620 @@
+#!/usr/bin/env python3
+"""native SNMP v2c/v3 client for check-plugins.
+
+One UDP session per host (see get_session). Several tables are walked at
+once: every GETBULK request carries one varbind per table that is not
+finished yet, so walking eight tables costs about as many round trips as
+walking the largest one. Walk results can be turned into Table objects,
+which keep one value list per column and a row index.
+
+cached_walk keeps walked subtrees per device on disk (marshal files, one
+per subtree) for a given TTL. Checks against the same device wait for
+the one walking it and reuse its result.
+
+Called as a script, it is a replacement for snmpget/snmpbulkwalk that
+prints '-Onq' style lines ("<oid> <value>") for lib/generic_snmp.shlib:
+
+	snmp.py get|walk [net-snmp options] [--cache-ttl <s>] <host> <oid> [<oid> ...]
+
+SNMPv3 privacy (AES-128 only) requires the python 'cryptography' package.
+"""
+
+import os
+import sys
+import time
+import hmac
+import socket
+import marshal
+import hashlib
+import argparse
+if __name__ == '__main__':
+	sys.path.append( os.path.join( os.path.dirname( os.path.abspath(__file__) ), '..' ) )
+from lib.cache import fingerprint, lock_file, write_atomic
+
+SNMP_PORT     = 161
+SNMP_TIMEOUT  = 5
+SNMP_RETRIES  = 3
+# varbinds requested per GETBULK request, shared by the tables walked
+SNMP_BULKSIZE = 60
+SNMP_CACHEDIR = '/var/tmp/check-plugins/snmp'
+# how long to wait for another check walking the same device (seconds)
+SNMP_LOCKWAIT = 60
+
+class SnmpError( Exception ):
+	pass
+
+class SnmpTimeout( SnmpError ):
+	pass
+
+#-----------------------------------------------------------------------
+# BER encoding
+#-----------------------------------------------------------------------
+INTEGER, OCTETSTRING, NULL, OID, SEQUENCE = 0x02, 0x04, 0x05, 0x06, 0x30
+IPADDRESS, COUNTER32, GAUGE32, TIMETICKS, OPAQUE, COUNTER64 = 0x40, 0x41, 0x42, 0x43, 0x44, 0x46
+NOSUCHOBJECT, NOSUCHINSTANCE, ENDOFMIBVIEW = 0x80, 0x81, 0x82
+GET, GETNEXT, RESPONSE, GETBULK, REPORT = 0xa0, 0xa1, 0xa2, 0xa5, 0xa8
+
+def _length( n ):
+	if n < 0x80:
+		return bytes( [n] )
+	raw = n.to_bytes( ( n.bit_length() + 7 ) // 8, 'big' )
+	return bytes( [ 0x80 | len(raw) ] ) + raw
+
+def _tlv( tag, content ):
+	return bytes( [tag] ) + _length( len(content) ) + content
+
+def _int( value, tag=INTEGER ):
+	raw = value.to_bytes( value.bit_length() // 8 + 1, 'big', signed=True )
+	return _tlv( tag, raw )
+
+def _str( value ):
+	return _tlv( OCTETSTRING, value )
+
+def _seq( *items ):
+	return _tlv( SEQUENCE, b''.join( items ) )
+
+def parse_oid( oid ):
+	"""'.1.3.6.1...' or '1.3.6.1...' to a tuple of ints"""
+	return tuple( int(x) for x in oid.strip('.').split('.') )
+
+def format_oid( oid ):
+	return '.' + '.'.join( str(x) for x in oid )
+
+def _oid( oid ):
+	raw = bytearray( [ 40 * oid[0] + oid[1] ] )
+	for sub in oid[2:]:
+		chunk = [ sub & 0x7f ]
+		sub >>= 7
+		while sub:
+			chunk.append( 0x80 | ( sub & 0x7f ) )
+			sub >>= 7
+		raw += bytes( reversed( chunk ) )
+	return _tlv( OID, bytes(raw) )
+
+def _decode( data, pos=0 ):
+	"""decode one TLV at 'pos'; returns (tag, content, next position)"""
+	tag = data[pos]
+	length = data[pos+1]
+	pos += 2
+	if length & 0x80:
+		n = length & 0x7f
+		length = int.from_bytes( data[pos:pos+n], 'big' )
+		pos += n
+	return tag, data[pos:pos+length], pos + length
+
+def _items( data ):
+	"""decode the contents of a sequence into a list of (tag, content)"""
+	items = []
+	pos = 0
+	while pos < len(data):
+		tag, content, pos = _decode( data, pos )
+		items.append( ( tag, content ) )
+	return items
+
+def _decode_oid( raw ):
+	oid = [ raw[0] // 40, raw[0] % 40 ]
+	sub = 0
+	for byte in raw[1:]:
+		sub = ( sub << 7 ) | ( byte & 0x7f )
+		if not byte & 0x80:
+			oid.append( sub )
+			sub = 0
+	return tuple( oid )
+
+def _decode_value( tag, raw ):
+	if tag == INTEGER:
+		return int.from_bytes( raw, 'big', signed=True )
+	if tag in ( COUNTER32, GAUGE32, TIMETICKS, COUNTER64 ):
+		return int.from_bytes( raw, 'big' )
+	if tag == OID:
+		return format_oid( _decode_oid( raw ) )
+	if tag == IPADDRESS:
+		return '.'.join( str(b) for b in raw )
+	if tag in ( NULL, NOSUCHOBJECT, NOSUCHINSTANCE, ENDOFMIBVIEW ):
+		return None
+	try:
+		return raw.decode()
+	except UnicodeDecodeError:
+		return bytes( raw )
+
+def _pdu( pdu_type, request_id, oids, non_repeaters=0, max_repetitions=0 ):
+	varbinds = b''.join( _seq( _oid(oid), _tlv( NULL, b'' ) ) for oid in oids )
+	return _tlv( pdu_type, _int( request_id ) + _int( non_repeaters ) +
+					_int( max_repetitions ) + _seq( varbinds ) )
+
+def _decode_pdu( raw_pdu ):
+	"""returns (pdu type, request id, error status, error index, varbinds)
+
+	Varbinds are (oid tuple, tag, value).
+	"""
+	pdu_type, content, _ = _decode( raw_pdu )
+	( _, reqid ), ( _, status ), ( _, index ), ( _, vbs ) = _items( content )
+	varbinds = []
+	for _, vb in _items( vbs ):
+		( _, oid ), ( tag, raw ) = _items( vb )
+		varbinds.append( ( _decode_oid( oid ), tag, _decode_value( tag, raw ) ) )
+	return ( pdu_type, int.from_bytes( reqid, 'big', signed=True ),
+			int.from_bytes( status, 'big' ), int.from_bytes( index, 'big' ), varbinds )
+
+#-----------------------------------------------------------------------
+# SNMPv3 user based security model (RFC 3414, 3826, 7860)
+#-----------------------------------------------------------------------
+AUTH_PROTOCOLS = {
+	# name: (hash, length of the truncated HMAC)
+	'MD5':     ( hashlib.md5,    12 ),
+	'SHA':     ( hashlib.sha1,   12 ),
+	'SHA-224': ( hashlib.sha224, 16 ),
+	'SHA-256': ( hashlib.sha256, 24 ),
+	'SHA-384': ( hashlib.sha384, 32 ),
+	'SHA-512': ( hashlib.sha512, 48 ),
+	}
+
+# AES-128 in CFB mode (RFC 3826)
+PRIV_PROTOCOLS = { 'AES', 'AES128', 'AES-128' }
+
+USM_REPORTS = {
+	( 1, 3, 6, 1, 6, 3, 15, 1, 1, 1, 0 ): 'unsupported security level',
+	( 1, 3, 6, 1, 6, 3, 15, 1, 1, 2, 0 ): 'not in time window',
+	( 1, 3, 6, 1, 6, 3, 15, 1, 1, 3, 0 ): 'unknown user name',
+	( 1, 3, 6, 1, 6, 3, 15, 1, 1, 4, 0 ): 'unknown engine ID',
+	( 1, 3, 6, 1, 6, 3, 15, 1, 1, 5, 0 ): 'wrong digest (authentication password?)',
+	( 1, 3, 6, 1, 6, 3, 15, 1, 1, 6, 0 ): 'decryption error (privacy password?)',
+	}
+
+def password_to_key( password, engine_id, hashfunc ):
+	"""localized key from a password (RFC 3414 A.2)"""
+	password = password.encode()
+	repeated = ( password * ( 1048576 // len(password) + 1 ) )[:1048576]
+	ku = hashfunc( repeated ).digest()
+	return hashfunc( ku + engine_id + ku ).digest()
+
+def _aes_cfb( key, iv, data, encrypt ):
+	try:
+		from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+	except ImportError:
+		raise SnmpError( 'SNMPv3 privacy requires the python cryptography package' )
+	try:
+		from cryptography.hazmat.decrepit.ciphers.modes import CFB
+	except ImportError:
+		from cryptography.hazmat.primitives.ciphers.modes import CFB
+	cipher = Cipher( algorithms.AES( key ), CFB( iv ) )
+	ctx = cipher.encryptor() if encrypt else cipher.decryptor()
+	return ctx.update( data ) + ctx.finalize()
+
+#-----------------------------------------------------------------------
+# Sessions
+#-----------------------------------------------------------------------
+class SnmpSession:
+	"""SNMP v2c or v3 session with one host"""
+
+	def __init__( self, host, community=None, user=None, authproto='MD5', authpass=None,
+				privproto='AES', privpass=None, seclevel=None, context='', port=SNMP_PORT,
+				timeout=SNMP_TIMEOUT, retries=SNMP_RETRIES ):
+		self.host = host
+		self.port = port
+		self.community = community
+		self.user = user
+		self.timeout = timeout
+		self.retries = retries
+		self._request_id = int.from_bytes( os.urandom(3), 'big' )
+
+		if user:
+			self.seclevel = seclevel or ( 'authPriv' if privpass else
+									'authNoPriv' if authpass else 'noAuthNoPriv' )
+			if authproto.upper() not in AUTH_PROTOCOLS:
+				raise SnmpError( 'unsupported auth protocol {}'.format( authproto ) )
+			# the priv key is the first 128 bit of the localized key: AES-192/256
+			# need a key extension (Blumenthal or Reeder) that is not implemented
+			if self.seclevel == 'authPriv' and privproto.upper() not in PRIV_PROTOCOLS:
+				raise SnmpError( 'unsupported privacy protocol {} (supported: AES, AES128; '
+					'use net-snmp for AES192/AES256)'.format( privproto ) )
+			self.auth = AUTH_PROTOCOLS[ authproto.upper() ]
+			self.authpass = authpass
+			self.privpass = privpass
+			self.context = context.encode()
+			self.engine_id = None
+
+		# name of the walk cache of this device and credential
+		credential = ( community, user, authpass, privpass, context )
+		self.cache_name = '{}_{}_{}'.format( host.replace( '/', '_' ), port,
+									fingerprint( credential )[:16] )
+
+		family, _, _, _, address = socket.getaddrinfo( host, port, type=socket.SOCK_DGRAM )[0]
+		self.sock = socket.socket( family, socket.SOCK_DGRAM )
+		self.sock.connect( address )
+
+	def close( self ):
+		self.sock.close()
+
+	def _next_id( self ):
+		self._request_id = ( self._request_id + 1 ) & 0x7fffffff
+		return self._request_id
+
+	def _exchange( self, message, match ):
+		"""send 'message' and return the first answer accepted by 'match'"""
+		for attempt in range( self.retries + 1 ):
+			self.sock.send( message )
+			deadline = time.monotonic() + self.timeout
+			while True:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				self.sock.settimeout( remaining )
+				try:
+					answer = self.sock.recv( 65535 )
+				except socket.timeout:
+					break
+				result = match( answer )
+				if result is not None:
+					return result
+		raise SnmpTimeout( 'Timeout: No Response from {}'.format( self.host ) )
+
+	#--- v2c
+	def _request_v2c( self, pdu_type, oids, non_repeaters=0, max_repetitions=0 ):
+		request_id = self._next_id()
+		message = _seq( _int( 1 ), _str( self.community.encode() ),
+				_pdu( pdu_type, request_id, oids, non_repeaters, max_repetitions ) )
+
+		def match( answer ):
+			try:
+				_, content, _ = _decode( answer )
+				pdu = _decode_pdu( _tlv( *_items( content )[2] ) )
+			except (IndexError, ValueError):
+				return None
+			return pdu if pdu[1] == request_id else None
+
+		return self._exchange( message, match )
+
+	#--- v3
+	def _discover( self ):
+		"""learn engine ID, boots and time of the agent"""
+		self.engine_id = b''
+		self.boots = self.engine_time = 0
+		self._request_v3( GET, [], secure=False )
+		if self.authpass:
+			self.auth_key = password_to_key( self.authpass, self.engine_id, self.auth[0] )
+		if self.seclevel == 'authPriv':
+			self.priv_key = password_to_key( self.privpass, self.engine_id, self.auth[0] )[:16]
+
+	def _engine_time( self ):
+		return self.engine_time + int( time.monotonic() - self.time_base )
+
+	def _request_v3( self, pdu_type, oids, non_repeaters=0, max_repetitions=0, secure=True, resync=True ):
+		auth = secure and self.seclevel in ( 'authNoPriv', 'authPriv' )
+		priv = secure and self.seclevel == 'authPriv'
+		msg_id = self._next_id()
+		request_id = self._next_id()
+		scoped = _seq( _str( self.engine_id ), _str( self.context ),
+					_pdu( pdu_type, request_id, oids, non_repeaters, max_repetitions ) )
+
+		boots = self.boots
+		etime = self._engine_time() if secure else 0
+		priv_params = b''
+		if priv:
+			priv_params = os.urandom( 8 )
+			iv = boots.to_bytes( 4, 'big' ) + etime.to_bytes( 4, 'big' ) + priv_params
+			scoped = _str( _aes_cfb( self.priv_key, iv, scoped, True ) )
+
+		digest_len = self.auth[1] if auth else 0
+		def message( auth_params ):
+			sec = _seq( _str( self.engine_id ), _int( boots ), _int( etime ),
+					_str( ( self.user if secure else '' ).encode() ),
+					_str( auth_params ), _str( priv_params ) )
+			flags = 0x04 | ( 0x01 if auth else 0 ) | ( 0x02 if priv else 0 )
+			header = _seq( _int( msg_id ), _int( 65507 ), _str( bytes([flags]) ), _int( 3 ) )
+			return _seq( _int( 3 ), header, _str( sec ), scoped )
+
+		data = message( bytes( digest_len ) )
+		if auth:
+			digest = hmac.new( self.auth_key, data, self.auth[0] ).digest()[:digest_len]
+			data = message( digest )
+
+		def match( answer ):
+			try:
+				_, content, _ = _decode( answer )
+				_, ( _, header ), ( _, sec ), ( scoped_tag, scoped ) = _items( content )
+				if int.from_bytes( _items( header )[0][1], 'big' ) != msg_id:
+					return None
+				( _, engine_id ), ( _, boots ), ( _, etime ), _, _, ( _, salt ) = _items( _decode( sec )[1] )
+				if scoped_tag == OCTETSTRING:
+					iv = boots.rjust( 4, b'\0' )[-4:] + etime.rjust( 4, b'\0' )[-4:] + salt
+					scoped = _decode( _aes_cfb( self.priv_key, iv, scoped, False ) )[1]
+				_, _, raw_pdu = _items( scoped )
+				pdu = _decode_pdu( _tlv( *raw_pdu ) )
+			except (IndexError, ValueError, TypeError):
+				return None
+			return ( pdu, engine_id, int.from_bytes( boots, 'big' ), int.from_bytes( etime, 'big' ) )
+
+		pdu, engine_id, boots, etime = self._exchange( data, match )
+
+		if pdu[0] == REPORT:
+			self.engine_id, self.boots, self.engine_time = engine_id, boots, etime
+			self.time_base = time.monotonic()
+			reason = USM_REPORTS.get( pdu[4][0][0] if pdu[4] else None )
+			if not secure:
+				return pdu
+			if reason == 'not in time window' and resync:
+				return self._request_v3( pdu_type, oids, non_repeaters, max_repetitions, resync=False )
+			raise SnmpError( 'SNMPv3: {}'.format( reason or 'report {}'.format( pdu[4] ) ) )
+		return pdu
+
+	def request( self, pdu_type, oids, non_repeaters=0, max_repetitions=0 ):
+		"""send one request; returns its varbinds"""
+		if self.user:
+			if self.engine_id is None:
+				self._discover()
+			pdu = self._request_v3( pdu_type, oids, non_repeaters, max_repetitions )
+		else:
+			pdu = self._request_v2c( pdu_type, oids, non_repeaters, max_repetitions )
+
+		if pdu[2]:
+			raise SnmpError( 'SNMP error status {} (index {})'.format( pdu[2], pdu[3] ) )
+		return pdu[4]
+
+	def get( self, oids ):
+		"""GET one or more OIDs; returns [(oid tuple, tag, value), ...]"""
+		return self.request( GET, [ parse_oid(o) if isinstance(o, str) else o for o in oids ] )
+
+	def walk( self, bases, bulksize=SNMP_BULKSIZE ):
+		"""walk several subtrees at once; returns {base: [(oid, tag, value), ...]}
+
+		Every GETBULK request carries the cursors of all unfinished subtrees;
+		the repetitions are shared between them. A subtree without any
+		object below it is fetched with GET, like snmpwalk does.
+		"""
+		bases = [ parse_oid(b) if isinstance(b, str) else b for b in bases ]
+		results = { base: [] for base in bases }
+		cursors = { base: base for base in bases }
+
+		while cursors:
+			active = list( cursors )
+			repetitions = max( 1, bulksize // len(active) )
+			try:
+				varbinds = self.request( GETBULK, [ cursors[b] for b in active ], 0, repetitions )
+			except SnmpError as e:
+				# tooBig: ask for less
+				if 'status 1 ' in str(e) and bulksize > len(active):
+					bulksize //= 2
+					continue
+				raise
+
+			done = set()
+			for i, ( oid, tag, value ) in enumerate( varbinds ):
+				base = active[ i % len(active) ]
+				if base in done:
+					continue
+				if tag == ENDOFMIBVIEW or oid[:len(base)] != base or oid <= cursors[base]:
+					done.add( base )
+					continue
+				results[base].append( ( oid, tag, value ) )
+				cursors[base] = oid
+			for base in done:
+				del cursors[base]
+			if not varbinds:
+				break
+
+		empty = [ base for base in bases if not results[base] ]
+		if empty:
+			for vb in self.get( empty ):
+				results[ vb[0] ].append( vb )
+		return results
+
+def _load_walk( path, ttl ):
+	try:
+		if time.time() - os.stat( path ).st_mtime > ttl:
+			return None
+		with open( path, 'rb' ) as fh:
+			return [ tuple(vb) for vb in marshal.load( fh ) ]
+	except (OSError, EOFError, ValueError, TypeError):
+		return None
+
+def cached_walk( session, bases, ttl, cachedir=None, bulksize=SNMP_BULKSIZE ):
+	"""like session.walk, reusing subtrees walked less than 'ttl' seconds ago
+
+	Missing subtrees are walked together while holding the lock of the
+	device. Without a usable cache directory, the subtrees are walked
+	directly.
+	"""
+	bases = [ parse_oid(b) if isinstance(b, str) else b for b in bases ]
+	cachedir = os.path.join( cachedir or SNMP_CACHEDIR, session.cache_name )
+	paths = { base: os.path.join( cachedir, format_oid( base )[1:] + '.walk' ) for base in bases }
+
+	def from_cache():
+		found = {}
+		for base in bases:
+			varbinds = _load_walk( paths[base], ttl )
+			if varbinds is not None:
+				found[base] = varbinds
+		return found
+
+	results = from_cache()
+	if len(results) == len(bases):
+		return results
+
+	try:
+		os.makedirs( cachedir, mode=0o700, exist_ok=True )
+		lock = lock_file( os.path.join( cachedir, '.lock' ), SNMP_LOCKWAIT )
+	except OSError:
+		return session.walk( bases, bulksize )
+
+	try:
+		# someone else might have walked it while we were waiting
+		results = from_cache()
+		missing = [ base for base in bases if base not in results ]
+		if missing:
+			walked = session.walk( missing, bulksize )
+			for base in missing:
+				try:
+					write_atomic( paths[base], marshal.dumps( walked[base] ), 'wb' )
+				except OSError:
+					pass
+			results.update( walked )
+		return results
+	finally:
+		if lock:
+			lock.close()
+
+_sessions = {}
+
+def get_session( host, **credentials ):
+	"""return the session for 'host', creating it on first use"""
+	key = ( host, tuple( sorted( credentials.items() ) ) )
+	if key not in _sessions:
+		_sessions[key] = SnmpSession( host, **credentials )
+	return _sessions[key]
+
+#-----------------------------------------------------------------------
+# Tables
+#-----------------------------------------------------------------------
+class Table:
+	"""walk result of one table entry OID, one value list per column
+
+	'index' holds the row indexes (as strings like '3' or '1.2') in the
+	order returned by the agent, 'columns' maps the column number to a
+	list of values aligned with 'index' (None where a row has no value).
+	"""
+
+	def __init__( self, base, varbinds ):
+		self.base = parse_oid(base) if isinstance(base, str) else base
+		self.index = []
+		self.columns = {}
+		rows = {}
+		for oid, tag, value in varbinds:
+			suffix = oid[ len(self.base): ]
+			if len(suffix) < 2:
+				continue
+			column, row = suffix[0], '.'.join( str(x) for x in suffix[1:] )
+			if row not in rows:
+				rows[row] = len(self.index)
+				self.index.append( row )
+				for values in self.columns.values():
+					values.append( None )
+			values = self.columns.setdefault( column, [None] * len(self.index) )
+			values[ rows[row] ] = value
+		self._rows = rows
+
+	def __len__( self ):
+		return len( self.index )
+
+	def value( self, column, row ):
+		return self.columns[column][ self._rows[ str(row) ] ]
+
+	def column( self, column ):
+		"""{row index: value} of one column"""
+		return dict( zip( self.index, self.columns.get( column, [] ) ) )
+
+	def rows( self ):
+		"""iterate over (row index, {column: value})"""
+		for pos, row in enumerate( self.index ):
+			yield row, { col: values[pos] for col, values in self.columns.items() }
+
+def walk_tables( session, bases, bulksize=SNMP_BULKSIZE ):
+	"""walk several tables at once; returns {base as given: Table}"""
+	results = session.walk( bases, bulksize )
+	return { base: Table( base, results[ parse_oid(base) if isinstance(base, str) else base ] )
+			for base in bases }
+
+#-----------------------------------------------------------------------
+# net-snmp compatible command line
+#-----------------------------------------------------------------------
+EXCEPTION_TEXT = {
+	NOSUCHOBJECT:   'No Such Object available on this agent at this OID',
+	NOSUCHINSTANCE: 'No Such Instance currently exists at this OID',
+	ENDOFMIBVIEW:   'No more variables left in this MIB View (It is past the end of the MIB tree)',
+	}
+
+def format_value( tag, value, numeric_ticks=False ):
+	"""value as printed by net-snmp with -Oq"""
+	if tag in EXCEPTION_TEXT:
+		return EXCEPTION_TEXT[tag]
+	if tag == NULL:
+		return '""'
+	if tag == TIMETICKS and not numeric_ticks:
+		seconds, hundredths = divmod( value, 100 )
+		minutes, seconds = divmod( seconds, 60 )
+		hours, minutes = divmod( minutes, 60 )
+		days, hours = divmod( hours, 24 )
+		return '{}:{}:{:02}:{:02}.{:02}'.format( days, hours, minutes, seconds, hundredths )
+	if isinstance( value, bytes ):
+		return ' '.join( '{:02X}'.format(b) for b in value )
+	if tag == OCTETSTRING:
+		if value and not value.isprintable():
+			return ' '.join( '{:02X}'.format(b) for b in value.encode() )
+		return '"{}"'.format( value )
+	return str( value )
+
+def main( argv=None ):
+	cli = argparse.ArgumentParser( description='snmpget/snmpbulkwalk replacement' )
+	cli.add_argument( 'command', choices=[ 'get', 'walk' ] )
+	cli.add_argument( '-v', dest='version', default='2c' )
+	cli.add_argument( '-c', dest='community', default='public' )
+	cli.add_argument( '-u', dest='user' )
+	cli.add_argument( '-a', dest='authproto', default='MD5' )
+	cli.add_argument( '-A', dest='authpass' )
+	cli.add_argument( '-x', dest='privproto', default='AES' )
+	cli.add_argument( '-X', dest='privpass' )
+	cli.add_argument( '-l', dest='seclevel' )
+	cli.add_argument( '-n', dest='context', default='' )
+	cli.add_argument( '-t', dest='timeout', type=float, default=SNMP_TIMEOUT )
+	cli.add_argument( '-r', dest='retries', type=int, default=SNMP_RETRIES )
+	cli.add_argument( '-O', dest='output', default='nq',
+			help='output options; values are always printed like -Onq, t: numeric timeticks' )
+	cli.add_argument( '--cache-ttl', dest='cache_ttl', type=int, default=0,
+			help='walk: reuse subtrees walked by other checks for this many seconds' )
+	cli.add_argument( '--cachedir', dest='cachedir', default=SNMP_CACHEDIR )
+	cli.add_argument( 'host' )
+	cli.add_argument( 'oids', nargs='+' )
+	args = cli.parse_args( argv )
+
+	host, _, port = args.host.rpartition( ':' ) if args.host.count(':') == 1 else ( args.host, '', '' )
+	try:
+		if args.version == '3':
+			session = SnmpSession( host, user=args.user, authproto=args.authproto,
+						authpass=args.authpass, privproto=args.privproto, privpass=args.privpass,
+						seclevel=args.seclevel, context=args.context, port=int( port or SNMP_PORT ),
+						timeout=args.timeout, retries=args.retries )
+		else:
+			session = SnmpSession( host, community=args.community, port=int( port or SNMP_PORT ),
+						timeout=args.timeout, retries=args.retries )
+
+		if args.command == 'get':
+			varbinds = session.get( args.oids )
+		else:
+			if args.cache_ttl > 0:
+				results = cached_walk( session, args.oids, args.cache_ttl, args.cachedir )
+			else:
+				results = session.walk( args.oids )
+			varbinds = [ vb for base in args.oids for vb in results[ parse_oid(base) ] ]
+	except (SnmpError, OSError, ValueError) as e:
+		print( str(e), file=sys.stderr )
+		return 1
+
+	numeric_ticks = 't' in args.output
+	for oid, tag, value in varbinds:
+		print( format_oid( oid ), format_value( tag, value, numeric_ticks ) )
+	return 0
+
+if __name__ == '__main__':
+	sys.exit( main() )
+
+# vim: ts=4:noexpandtab:sw=4:sts=4:ai:smartindent:filetype=python:nofoldenable
@@ -3,7 +3,21 @@
 # Run checks against HPE WSAPI
 # (tested with HPE Alletra)
 #
-program_version=str(1.0)
+program_version=str(1.4)
+# Version 1.4
+#	volumes, disks: --metrics-spool writes the usage of all objects to a
+#	metrics spool file (lib/metrics); the perfdata keeps the counts and
+#	the --perfdata-max objects with the highest usage
+#
+# Version 1.3
+#	tabulate2 and requests are imported only when needed
+#
+# Version 1.2
+#	volumes: perfdata collected in a CheckResult, labels quoted if needed
+#
+# Version 1.1
+#	reuse session keys between checks (--cachedir), option --logout
+#
 # Version 1.0
 #	bugfixes, refactor
 #
@@ -15,11 +29,11 @@ program_version=str(1.0)
 #
 import os, sys
 import argparse
-import requests
-from tabulate2 import tabulate
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from lib.generic_plugin import *
 from lib.jsonapi import *
+from lib.session import cached_login, drop_session
+from lib.metrics import MetricsSink, FORMATS, METRICS_FORMAT, PERFDATA_MAX
 
 # parse command line parameters
 cli = argparse.ArgumentParser \
@@ -33,6 +47,16 @@ cli.add_argument('--mode',
 		help='check mode: disks | ...', required = True )
 cli.add_argument('-H', dest = 'host',
 		help='Hostname or IP address', required = True)
+cli.add_argument('--cachedir',
+		help='path to session cache', default='/var/spool/icinga2/tmp' )
+cli.add_argument('--logout', action='store_true',
+		help='delete the session key after the check instead of reusing it')
+cli.add_argument('--metrics-spool',
+		help='directory of the metrics spool for the values of all objects (default: off)')
+cli.add_argument('--metrics-format', choices=list( FORMATS ), default=METRICS_FORMAT,
+		help='format of the metrics spool (default {})'.format( METRICS_FORMAT ))
+cli.add_argument('--perfdata-max', type=int,
+		help='objects in the perfdata, highest usage first (default: all, {} with --metrics-spool)'.format( PERFDATA_MAX ))
 cli.add_argument('-d', '--debug', 
 		help='enable debugging output', action="store_true")
 cli.add_argument('--version', 
@@ -54,6 +78,14 @@ if DEBUG:
 	import pprint
 	pp = pprint.PrettyPrinter(indent=4, compact=True, sort_dicts=True)
 
+# usage of all objects; the perfdata keeps perf_max of them
+sink = MetricsSink( args.metrics_spool, 'hpe', { 'host': args.host },
+	args.metrics_format ) if args.metrics_spool else None
+perf_max = args.perfdata_max if args.perfdata_max is not None else ( PERFDATA_MAX if sink else None )
+
+# WSAPI drops session keys after 15 minutes of inactivity
+SESSION_TTL = 600
+
 #-----------------------------------------------------------------------
 # Functions
 #-----------------------------------------------------------------------
@@ -99,21 +131,38 @@ def delSessionKey( host, sessionKey ):
 
 	return None
 
-def checkVolumes(host, sessionKey):
+def getSession( host ):
+	credential = ( args.user, args.pwd )
+	login = lambda: ( getSessionKey( host, args.user, args.pwd ), SESSION_TTL )
+	return cached_login( 'hpe_wsapi', host, credential, login, args.cachedir )['token']
+
+def wsapiGet( host, path ):
+	# GET with the cached session key. If the key was rejected, log in
+	# again once.
+	credential = ( args.user, args.pwd )
+	for attempt in ( 1, 2 ):
+		header={
+			'Accept': 'application/json',
+			'X-HP3PAR-WSAPI-SessionKey': getSession( host )
+			}
+		answer, error = apiRequest( f'https://{host}{path}', 'get', verify=False, header=header)
+		if answer is not None:
+			break
+		drop_session( 'hpe_wsapi', host, credential, args.cachedir )
+
+	return answer, error
+
+def checkVolumes(host):
 	rcode=0
 	output=''
 	detail=''
 	perfdata=''
+	result = CheckResult( sink=sink, perf_max=perf_max )
 	# fetch this fields from API
 	# interessting fields: name, state, totalUsedMiB, sizeMiB
-	url=f'https://{host}/api/v1/volumes'
-	header={
-		'Accept': 'application/json',
-		'X-HP3PAR-WSAPI-SessionKey': sessionKey
-		}
 
 	# API-Call
-	answer, error = apiRequest( url, 'get', verify=False, header=header)
+	answer, error = wsapiGet( host, '/api/v1/volumes' )
 
 	if answer.get('members'):
 		# Init output table header
@@ -167,12 +216,16 @@ def checkVolumes(host, sessionKey):
 			table.append( volume_infos )
 
 			# append perfdata
-			perfdata += "{}={}%;{};{};0;100 ".format(
-					vol.get('name'), vol['pctusage'], warnLevel, critLevel )
+			result.metric( vol.get('name'), vol['pctusage'], '%', warnLevel, critLevel, 0, 100,
+				name='volume_used', labels={ 'volume': vol.get('name') } )
 
 		# Generate ASCII table for details
+		from tabulate2 import tabulate
 		detail = tabulate(table, headers = head, 
 					colglobalalign='right', colalign = ('left','left') )
+		result.perf( 'volumes', cOK )
+		result.perf( 'volumes_problems', cProblems )
+		perfdata = result.render_perfdata()
 
 		detail += "\n\nNote: Commas ',' in numbers are thousand separators."
 		# plugin output (first line)
@@ -192,21 +245,17 @@ def checkVolumes(host, sessionKey):
 
 	return rcode, output, detail, perfdata
 
-def checkDisks(host, sessionKey):
+def checkDisks(host):
 	rcode=0
 	output=''
 	detail=''
 	perfdata=''
+	result = CheckResult( sink=sink, perf_max=perf_max )
 	# fetch this fields from API
 	# interessting fields: name, state, totalUsedMiB, sizeMiB
-	url=f'https://{host}/api/v1/disks'
-	header={
-		'Accept': 'application/json',
-		'X-HP3PAR-WSAPI-SessionKey': sessionKey
-		}
 
 	# API-Call
-	answer, error = apiRequest( url, 'get', verify=False, header=header)
+	answer, error = wsapiGet( host, '/api/v1/disks' )
 
 	if answer.get('members'):
 		# Output table header
@@ -244,10 +293,15 @@ def checkDisks(host, sessionKey):
 			table.append( disk_infos )
 
 			# append perfdata
-			perfdata += "{}={}% ".format( disk.get('name'), disk['pctusage'] )
+			result.metric( disk.get('name'), disk['pctusage'], '%',
+				name='disk_used', labels={ 'disk': disk.get('name') } )
 
 		# Generate ASCII table for details
+		from tabulate2 import tabulate
 		detail = tabulate(table, headers = head)
+		result.perf( 'disks', len( table ) )
+		result.perf( 'disks_problems', cProblems )
+		perfdata = result.render_perfdata()
 		detail += "\n\nNote: Commas ',' in numbers are thousand separators."
 
 		# plugin output (first line)
@@ -266,17 +320,12 @@ def checkDisks(host, sessionKey):
 
 	return rcode, output, detail, perfdata
 
-def systemInfo( host, sessionKey):
+def systemInfo( host ):
 	rcode=0
 	output=''
 	detail=''
 	# fetch this fields from API
 	# interessting fields: name, systemVersion, model, serialNumber, totalNodes
-	url=f'https://{host}/api/v1/system'
-	header={
-		'Accept': 'application/json',
-		'X-HP3PAR-WSAPI-SessionKey': sessionKey
-		}
 
 	map_field2output = {
 			'name': 'Name', 
@@ -285,7 +334,7 @@ def systemInfo( host, sessionKey):
 			'serialNumber': 'Serial Number', 'totalNodes': 'Number of Nodes' 
 			}
 	# API-Call
-	answer, error = apiRequest( url, 'get', verify=False, header=header)
+	answer, error = wsapiGet( host, '/api/v1/system' )
 
 	# check for valid answer
 	table=[]
@@ -293,6 +342,7 @@ def systemInfo( host, sessionKey):
 		for field in map_field2output.keys():
 			infos=[ map_field2output[field], answer.get(field) ]
 			table.append( infos )
+		from tabulate2 import tabulate
 		detail = tabulate(table)
 	else:
 		print('could not get system information')
@@ -333,22 +383,26 @@ def _diskStateEnum( num ):
 #								  MAIN
 #-----------------------------------------------------------------------
 
-#--------------------------- get session key ---------------------------
-
-# get a session key
-sessionKey = getSessionKey( args.host, args.user, args.pwd )
-
 if args.mode == 'info':
-	( rcode, out_text, detail) = systemInfo( args.host, sessionKey )
+	( rcode, out_text, detail) = systemInfo( args.host )
 if args.mode == 'volumes':
-	( rcode, out_text, detail, perfdata) = checkVolumes( args.host, sessionKey )
+	( rcode, out_text, detail, perfdata) = checkVolumes( args.host )
 if args.mode == 'disks':
-	( rcode, out_text, detail, perfdata) = checkDisks( args.host, sessionKey )
+	( rcode, out_text, detail, perfdata) = checkDisks( args.host )
 if args.mode == 'capacity':
-	( rcode, out_text, detail) = checkCapacity( args.host, sessionKey )
-
-# delete the session key
-delSessionKey( args.host, sessionKey )
+	( rcode, out_text, detail) = checkCapacity( args.host )
+
+# delete the session key, if requested
+if args.logout:
+	delSessionKey( args.host, getSession( args.host ) )
+	drop_session( 'hpe_wsapi', args.host, ( args.user, args.pwd ), args.cachedir )
+
+# usage of all objects to the metrics spool
+if sink:
+	try:
+		sink.flush()
+	except OSError as e:
+		detail = ( detail or '' ) + '\n\nmetrics spool not written: {}'.format( e )
 
 #
 #Finally, print check output and exit with rcode
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
 # Imports
-import argparse, requests, sys, os
+import argparse, sys, os, re, json
+from datetime import datetime, timedelta, timezone
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.jsonapi import http_request
+from lib.session import cached_login, cached_fact, drop_session
+from lib.cache import write_atomic
 
 # Variables
-requests.packages.urllib3.disable_warnings()
-checkVersion = '1.3'
+checkVersion = '1.5.2'
+# Sessions kept per job and page size when fetching new sessions
+sessionHistory = 10
+sessionPageSize = 500
 
 # Functions
 def parse_command_line():
@@ -15,7 +22,12 @@ def parse_command_line():
     parser.add_argument('--username', type=str, help='Veeam Username')
     parser.add_argument('--password', type=str, help='Veeam Password')
     parser.add_argument('--tmpdir', type=str, default='/var/tmp',
-                        help='Directory for status file (default: /var/tmp)')
+                        help='Directory for status and session files (default: /var/tmp)')
+    parser.add_argument('--history-days', type=int, default=31,
+                        help='Days the first run looks back for the last sessions of each job (default: 31)')
+    parser.add_argument('--max-running', type=float, default=24,
+                        help='Hours an unfinished session holds back the session cursor; older ones '
+                             'are refreshed by id (default: 24)')
     args = parser.parse_args()
     return args
 
@@ -27,7 +39,7 @@ def login_to_rest_api(hostname, username, password):
         'username': username,
         'password': password
     }
-    response = requests.post(url, headers=headers, data=data, verify=False, timeout=30)
+    response = http_request(url, 'post', headers=headers, data=data, verify=False)
     
     if response.status_code != 200:
         print('Error: Failed to authenticate. Exiting script.')
@@ -36,17 +48,43 @@ def login_to_rest_api(hostname, username, password):
     response_json = response.json()
     access_token = response_json.get('access_token')
     
-    return access_token
+    return access_token, response_json.get('expires_in', 900)
 
-def get_veeam_version(hostname, access_token):
-    url = 'https://' + hostname + ':9419/api/v1/serverInfo'
+def get_access_token(hostname, username, password):
+    # Reuse the access token of earlier checks until it expires
+    login = lambda: login_to_rest_api(hostname, username, password)
+    session = cached_login('veeam', hostname, (username, password), login, args.tmpdir)
+    return session['token']
+
+def api_get(hostname, path, api_version):
+    # The token is looked up per request: a token renewed after a 401 is
+    # used by all later requests of this and other checks
+    url = 'https://' + hostname + ':9419' + path
+    credential = (args.username, args.password)
+    access_token = get_access_token(hostname, args.username, args.password)
     headers = {
-        'x-api-version': '1.1-rev0',
+        'x-api-version': api_version,
         'Authorization': 'Bearer ' + access_token
     }
-    response = requests.get(url, headers=headers, verify=False, timeout=30)
+    response = http_request(url, headers=headers, verify=False)
+
+    if response.status_code == 401:
+        # Token revoked or expired early: log in again once, unless another
+        # check already did
+        drop_session('veeam', hostname, credential, args.tmpdir, token=access_token)
+        headers['Authorization'] = 'Bearer ' + get_access_token(hostname, args.username, args.password)
+        response = http_request(url, headers=headers, verify=False)
+    return response
+
+def get_veeam_version(hostname):
+    response = api_get(hostname, '/api/v1/serverInfo', '1.1-rev0')
     return response.json()['buildVersion']
 
+def get_cached_veeam_version(hostname):
+    # The server version rarely changes, don't ask for it on every check
+    fetch = lambda: get_veeam_version(hostname)
+    return cached_fact('veeam', hostname, (args.username, args.password), 'buildVersion', fetch, args.tmpdir)
+
 def set_api_version(veeam_version):
     if veeam_version == '12.2.0.334':
         return '1.1-rev2'
@@ -55,13 +93,8 @@ def set_api_version(veeam_version):
     else:
         return '1.1-rev0'
 
-def get_all_backups(hostname, access_token, api_version):
-    url = 'https://' + hostname + ':9419/api/v1/backups?orderColumn=Name'
-    headers = {
-        'x-api-version': api_version,
-        'Authorization': 'Bearer ' + access_token
-    }
-    response = requests.get(url, headers=headers, verify=False, timeout=30)
+def get_all_backups(hostname, api_version):
+    response = api_get(hostname, '/api/v1/backups?orderColumn=Name', api_version)
     
     if response.status_code != 200:
         print('Error: Failed to get backups. Exiting script.')
@@ -78,13 +111,8 @@ def extract_backup_ids(backups):
             backup_ids.append(backup_id)
     return backup_ids
 
-def get_all_jobs(hostname, access_token, api_version):
-    url = 'https://' + hostname + ':9419/api/v1/jobs?orderColumn=Name'
-    headers = {
-        'x-api-version': api_version,
-        'Authorization': 'Bearer ' + access_token
-    }
-    response = requests.get(url, headers=headers, verify=False, timeout=30)
+def get_all_jobs(hostname, api_version):
+    response = api_get(hostname, '/api/v1/jobs?orderColumn=Name', api_version)
     
     if response.status_code != 200:
         print('Error: Failed to get jobs. Exiting script.')
@@ -93,32 +121,128 @@ def get_all_jobs(hostname, access_token, api_version):
     response_json = response.json()
     return response_json['data']
 
-def get_backup_sessions(hostname, access_token, backup_ids, api_version):
-    sessions = []
-    for backup_id in backup_ids:
-        url = 'https://' + hostname + ':9419/api/v1/sessions?orderColumn=CreationTime&jobIdFilter=' + backup_id['jobId'] + '&Limit=10'
-        headers = {
-            'x-api-version': api_version,
-            'Authorization': 'Bearer ' + access_token
-        }
-        response = requests.get(url, headers=headers, verify=False, timeout=30)
-        
+def parse_time(value):
+    # Veeam sends up to 7 fractional digits, older Pythons only parse 6
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value).replace('Z', '+00:00')
+    return datetime.fromisoformat(value)
+
+def format_time(value):
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def get_sessions_since(hostname, api_version, since, ascending=True):
+    # All sessions created after 'since', page by page: oldest first, or
+    # newest first with ascending=False
+    skip = 0
+    order = 'true' if ascending else 'false'
+    while True:
+        path = '/api/v1/sessions?orderColumn=CreationTime&orderAsc=' + order + '&createdAfterFilter=' + format_time(since) + '&skip=' + str(skip) + '&limit=' + str(sessionPageSize)
+        response = api_get(hostname, path, api_version)
+
         if response.status_code != 200:
-            print('Error: Failed to get sessions for backup ID ' + backup_id['jobId'] + '. Skipping.')
+            print('Error: Failed to get sessions. Exiting script.')
+            sys.exit(2)
+
+        page = response.json()['data']
+        for session in page:
+            yield session
+        if len(page) < sessionPageSize:
+            break
+        skip += len(page)
+
+def get_session(hostname, api_version, session_id):
+    # One session by id, None if it does not exist any more
+    response = api_get(hostname, '/api/v1/sessions/' + session_id, api_version)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        print('Error: Failed to get session. Exiting script.')
+        sys.exit(2)
+    return response.json()
+
+def load_session_history(statefile):
+    try:
+        with open(statefile, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {'cursor': None, 'jobs': {}}
+
+def get_backup_sessions(hostname, backup_ids, api_version):
+    # The last sessions per job are kept in a state file. Each run only
+    # fetches sessions created since the cursor and merges them in.
+    statefile = args.tmpdir + '/check_veeam_sessions-' + args.host
+    history = load_session_history(statefile)
+    current_jobs = set(backup_id['jobId'] for backup_id in backup_ids)
+    jobs = history['jobs']
+
+    def merge(session):
+        job_sessions = [s for s in jobs.get(session['jobId'], []) if s['id'] != session['id']]
+        job_sessions.append({
+            'id': session['id'],
+            'creationTime': session['creationTime'],
+            'state': session['state'],
+            'result': session['result']['result']
+        })
+        jobs[session['jobId']] = job_sessions
+
+    if history['cursor']:
+        # one second overlap, sessions already known are replaced by id
+        since = parse_time(history['cursor']) - timedelta(seconds=1)
+        for session in get_sessions_since(hostname, api_version, since):
+            merge(session)
+    else:
+        # first run: newest sessions first, until every job has its last
+        # sessions or --history-days are read
+        since = datetime.now(timezone.utc) - timedelta(days=args.history_days)
+        missing = dict.fromkeys(current_jobs, sessionHistory)
+        for session in get_sessions_since(hostname, api_version, since, ascending=False):
+            merge(session)
+            if session['jobId'] in missing:
+                missing[session['jobId']] -= 1
+                if not missing[session['jobId']]:
+                    del missing[session['jobId']]
+                    if not missing:
+                        break
+
+    # keep the newest sessions of current jobs only
+    for job_id in list(jobs):
+        if job_id not in current_jobs:
+            del jobs[job_id]
             continue
-        
-        response_json = response.json()
-        sessiondata = {'name': backup_id['name'], 'sessions': response_json['data']}
-        sessions.append(sessiondata)
+        jobs[job_id] = sorted(jobs[job_id], key=lambda s: parse_time(s['creationTime']), reverse=True)[:sessionHistory]
+
+    # sessions running longer than --max-running (e.g. continuous jobs) do
+    # not hold the cursor back, they are refreshed by id instead
+    running_since = datetime.now(timezone.utc) - timedelta(hours=args.max_running)
+    for job_id in jobs:
+        for s in list(jobs[job_id]):
+            if s['state'] != 'Stopped' and parse_time(s['creationTime']) < running_since:
+                session = get_session(hostname, api_version, s['id'])
+                if session is None:
+                    jobs[job_id].remove(s)
+                else:
+                    s['state'] = session['state']
+                    s['result'] = session['result']['result']
+
+    # next run starts at the oldest unfinished session, or the newest one
+    unfinished = [parse_time(s['creationTime']) for job in jobs.values() for s in job
+                  if s['state'] != 'Stopped' and parse_time(s['creationTime']) >= running_since]
+    known = [parse_time(s['creationTime']) for job in jobs.values() for s in job]
+    if unfinished:
+        history['cursor'] = format_time(min(unfinished))
+    elif known:
+        history['cursor'] = format_time(max(known))
+    else:
+        history['cursor'] = format_time(since)
+
+    write_atomic(statefile, json.dumps(history))
+
+    sessions = []
+    for backup_id in backup_ids:
+        sessions.append({'name': backup_id['name'], 'sessions': jobs.get(backup_id['jobId'], [])})
     return sessions
 
-def get_veeam_repositories_state(hostname, access_token, api_version):
-    url = 'https://' + hostname + ':9419/api/v1/backupInfrastructure/repositories/states'
-    headers = {
-        'x-api-version': api_version,
-        'Authorization': 'Bearer ' + access_token
-    }
-    response = requests.get(url, headers=headers, verify=False, timeout=30)
+def get_veeam_repositories_state(hostname, api_version):
+    response = api_get(hostname, '/api/v1/backupInfrastructure/repositories/states', api_version)
     if response.status_code != 200:
         print('Error: Failed to get repositories states. Exiting script.')
         sys.exit(2)
@@ -135,7 +259,7 @@ def create_backup_check(backups):
         if len(sessions) < 3:
             continue
         recent_sessions = [session for session in sessions if session['state'] == 'Stopped'][:3]
-        session_results = [session['result']['result'] for session in recent_sessions]
+        session_results = [session['result'] for session in recent_sessions]
         last3results = session_results[0]+', '+session_results[1]+', '+session_results[2]
         if session_results[0] == 'Success':
             job_result = 'OK'
@@ -248,34 +372,30 @@ def output_repo_state_check(repos):
 args = parse_command_line()
 
 if args.check == 'backup' and args.host != None and args.username != None and args.password != None:
-    access_token = login_to_rest_api(args.host, args.username, args.password)
-    veeam_version = get_veeam_version(args.host, access_token)
+    veeam_version = get_cached_veeam_version(args.host)
     api_version = set_api_version(veeam_version)
-    backups = get_all_backups(args.host, access_token, api_version)
+    backups = get_all_backups(args.host, api_version)
     backup_ids = extract_backup_ids(backups)
-    sessions = get_backup_sessions(args.host, access_token, backup_ids, api_version)
+    sessions = get_backup_sessions(args.host, backup_ids, api_version)
     backup_check = create_backup_check(sessions)
     output_backup_check(backup_check)
 
 elif args.check == 'jobs' and args.host != None and args.username != None and args.password != None:
-    access_token = login_to_rest_api(args.host, args.username, args.password)
-    veeam_version = get_veeam_version(args.host, access_token)
+    veeam_version = get_cached_veeam_version(args.host)
     api_version = set_api_version(veeam_version)
-    backups = get_all_backups(args.host, access_token, api_version)
+    backups = get_all_backups(args.host, api_version)
     backup_ids = extract_backup_ids(backups)
     job_check = compare_jobs(backup_ids)
     output_job_check(job_check)
 
 elif args.check == 'version' and args.host != None and args.username != None and args.password != None:
-    access_token = login_to_rest_api(args.host, args.username, args.password)
-    veeam_version = get_veeam_version(args.host, access_token)
+    veeam_version = get_veeam_version(args.host)
     output_version_check(veeam_version, checkVersion)
 
 elif args.check == 'repository' and args.host != None and args.username != None and args.password != None:
-    access_token = login_to_rest_api(args.host, args.username, args.password)
-    veeam_version = get_veeam_version(args.host, access_token)
+    veeam_version = get_cached_veeam_version(args.host)
     api_version = set_api_version(veeam_version)
-    repo_states = get_veeam_repositories_state(args.host, access_token, api_version)
+    repo_states = get_veeam_repositories_state(args.host, api_version)
     repos = create_repo_state_check(repo_states)
     output_repo_state_check(repos)
 